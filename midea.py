@@ -1,84 +1,1407 @@
+import io
 import os
+import sys
 import json
+import time
+import queue
+import atexit
+import asyncio
 import sqlite3
 import logging
-from datetime import datetime
+import logging.handlers
+import zlib
+import mmap
+import struct
+import shutil
+import tarfile
+import zipfile
+import hashlib
+import tempfile
+import argparse
+import mimetypes
+import threading
+import traceback
+import multiprocessing
+import concurrent.futures
+from collections import Counter, OrderedDict
+from dataclasses import asdict, dataclass, replace
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from typing import Optional
 
-# Configure logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+# Optional: peak memory reporting in load tests (Unix only)
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Optional: perceptual near-duplicate detection for photos
+try:
+    import numpy as np
+    from PIL import Image
+except ImportError:
+    np = Image = None
+from telegram import InputMediaPhoto, Update
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.ext import (
+    Application, ApplicationHandlerStop, CommandHandler, MessageHandler, TypeHandler, filters, ContextTypes
 )
+from telegram.request import BaseRequest
+
+# Logging goes through a queue to a listener thread (see setup_logging);
+# pass values as arguments so messages are only formatted when emitted
 logger = logging.getLogger(__name__)
+audit_logger = logging.getLogger(f"{__name__}.audit")
 
-BOT_TOKEN = "8396790178:AAGdB6U1SahvrhUyG8xCMCRYaHVNpvlMGx8"
-LOG_GROUP_ID = -1001902619247  # Replace with your log group ID (negative number)
+BOT_TOKEN = os.environ.get("MIDEA_BOT_TOKEN", "8396790178:AAGdB6U1SahvrhUyG8xCMCRYaHVNpvlMGx8")
+LOG_GROUP_IDS = [-1001902619247]  # Replace with your log group IDs (negative numbers)
+
+# Sharding: None gives every log group its own database and media root,
+# a number hashes the groups into that many shards instead
+SHARD_COUNT = None
+# Shards served by this process (e.g. MIDEA_SHARDS=0,1), None serves them all.
+# Each process splitting the shards needs its own bot token (MIDEA_BOT_TOKEN).
+OWNED_SHARDS = (
+    {int(shard) for shard in os.environ["MIDEA_SHARDS"].split(",")}
+    if os.environ.get("MIDEA_SHARDS") else None
+)
+MEDIA_ROOT = Path("saved_media")
+
+# Media type -> subdirectory inside each shard's media root
+MEDIA_SUBDIRS = {
+    'video': "videos",
+    'photo': "photos",
+    'audio': "audio",
+    'voice': "voice",
+    'video_note': "video_notes",
+    'document': "documents",
+    'animation': "animations"
+}
+
+# Write-behind buffer: pending writes are committed together every N ms or M rows
+WRITE_FLUSH_INTERVAL_MS = 50
+WRITE_BATCH_SIZE = 200
+
+# Number of rendered captions and list pages kept in memory
+RENDER_CACHE_SIZE = 1024
+
+# Batch saving: media seen in log groups is remembered (per group) so /saveall
+# and album saves can reach it; the Bot API cannot fetch chat history
+RECENT_MEDIA_LIMIT = 2000
+SAVE_CONCURRENCY = 4
+PROGRESS_INTERVAL = 2.0  # seconds between progress message edits
+
+# Near-duplicate photos (needs numpy and Pillow): dHash Hamming distance at or
+# below which two photos count as the same picture. The band index finds
+# every match up to 7.
+NEAR_DUPLICATE_DISTANCE = 6
+SKIP_NEAR_DUPLICATES = False  # Don't save photos that near-duplicate a saved one
+HASH_WORKERS = None  # Process pool size, None uses every CPU
+
+# Image variants (needs Pillow): compact copies of photos and GIF animations made
+# at ingest in the process pool, used by /preview and `/list grid`; {} disables them
+IMAGE_VARIANTS = {
+    'thumb': {'max_side': 320, 'format': 'JPEG', 'quality': 70},
+    'preview': {'max_side': 1280, 'format': 'JPEG', 'quality': 82}
+}
+VARIANT_MEDIA_TYPES = ('photo', 'animation')
+VARIANT_EXTENSIONS = {'JPEG': '.jpg', 'WEBP': '.webp', 'PNG': '.png'}
+
+# Diagnostics: log the blocking stack when the event loop stalls longer than
+# this many seconds; None starts no watchdog at all
+LOOP_LAG_THRESHOLD = None
+LOOP_WATCHDOG_INTERVAL = 0.1
+# /profile samples every thread's stack and replies with a folded flame graph file
+ADMIN_USER_IDS = set()  # Telegram user ids allowed to run /profile and /broadcast
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_MAX_SECONDS = 120
+
+# Logging: console format and level, plus a rotating JSON Lines audit log of
+# saves, retrievals and deletes (None disables it)
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_LEVEL = logging.INFO
+AUDIT_LOG_FILE = MEDIA_ROOT / "audit.jsonl"
+AUDIT_LOG_MAX_BYTES = 50 * 1024 * 1024
+AUDIT_LOG_BACKUPS = 5
+
+# Load testing: when set, the bot appends sanitized incoming updates to this
+# JSON Lines file for `python midea.py loadtest replay`
+RECORD_UPDATES_FILE = None
+LOADTEST_MAX_FILE_BYTES = 256 * 1024  # cap on fake download sizes during replay
+
+# Retention rules: media matching a rule expires once older than max_age_days.
+# Optional filters: media_type, sender_id, min_size, max_size (bytes).
+# Expiry runs on the JobQueue: pip install "python-telegram-bot[job-queue]"
+RETENTION_RULES = [
+    # {'media_type': 'voice', 'max_age_days': 30},
+    # {'min_size': 100 * 1024 * 1024, 'max_age_days': 90},
+]
+RETENTION_INTERVAL = 3600  # seconds between expiry runs
+RETENTION_BATCH_SIZE = 100  # rows deleted per batch
+RETENTION_BATCH_DELAY = 1.0  # seconds between batches so expiry yields to interactive traffic
+RETENTION_DRY_RUN = False  # Only log what would expire
+
+# Warm start: in-memory caches (file_ids, rendered captions and pages, recent
+# log group media) are snapshotted to this file in the media root on shutdown
+# and every SNAPSHOT_INTERVAL seconds, then read lazily after a restart.
+# Entries for media changed since the snapshot are ignored. None disables.
+SNAPSHOT_FILE = "catalog.snapshot"
+SNAPSHOT_INTERVAL = 600
+
+# /broadcast: fan saved media out to many chats. Each media is uploaded once and
+# its file_id reused for every other chat.
+BROADCAST_CONCURRENCY = 8  # chats delivered to at once
+BROADCAST_RATE = 25  # sends per second across all chats (Telegram allows about 30)
+BROADCAST_RETRIES = 3  # extra attempts per chat after timeouts or flood waits
+BROADCAST_MAX_FILES = 10  # media a query may match
+BROADCAST_MAX_TARGETS = 500
+
+# Admin CLI (python midea.py admin ...): rows per transaction during bulk work
+ADMIN_BATCH_SIZE = 5000
+
+# Online backup: pages copied per backup step and the pause between steps that
+# lets writers in (also the retry delay when a step finds the database busy)
+BACKUP_PAGES_PER_STEP = 1024
+BACKUP_STEP_SLEEP = 0.05
+EXPORT_BUFFER_SIZE = 1 << 20
+
+# File extension -> media type for imported files outside the media subdirectories
+IMPORT_EXTENSIONS = {
+    '.jpg': 'photo', '.jpeg': 'photo', '.png': 'photo', '.webp': 'photo',
+    '.mp4': 'video', '.mov': 'video', '.mkv': 'video', '.webm': 'video',
+    '.mp3': 'audio', '.m4a': 'audio', '.flac': 'audio', '.wav': 'audio',
+    '.ogg': 'voice', '.oga': 'voice',
+    '.gif': 'animation'
+}
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue records unformatted so formatting happens on the listener thread"""
+
+    def prepare(self, record):
+        return record
+
+class JsonLinesFormatter(logging.Formatter):
+    """One JSON object per record: time, event and the record's audit fields"""
+
+    def format(self, record):
+        return json.dumps(
+            {'time': round(record.created, 3), 'event': record.getMessage(), **getattr(record, 'audit', {})},
+            default=str, ensure_ascii=False
+        )
+
+def setup_logging(level=LOG_LEVEL, audit_file=AUDIT_LOG_FILE):
+    """Send all logging through a queue to handlers on a background thread; returns the listener"""
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter(LOG_FORMAT))
+    console.addFilter(lambda record: not record.name.startswith(audit_logger.name))
+    handlers = [console]
+    
+    if audit_file:
+        Path(audit_file).parent.mkdir(parents=True, exist_ok=True)
+        audit_handler = logging.handlers.RotatingFileHandler(
+            audit_file, maxBytes=AUDIT_LOG_MAX_BYTES, backupCount=AUDIT_LOG_BACKUPS, encoding='utf-8'
+        )
+        audit_handler.setFormatter(JsonLinesFormatter())
+        audit_handler.addFilter(logging.Filter(audit_logger.name))
+        handlers.append(audit_handler)
+        audit_logger.setLevel(logging.INFO)
+    else:
+        # Otherwise audit() would build and queue records only for the console filter to drop them
+        audit_logger.setLevel(logging.CRITICAL + 1)
+    
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+def audit(event, **fields):
+    """Record a structured audit event; costs one level check when auditing is off"""
+    if audit_logger.isEnabledFor(logging.INFO):
+        audit_logger.info(event, extra={'audit': fields})
+
+def format_file_size(size_bytes):
+    """Format file size in human readable format"""
+    if not size_bytes:
+        return "0 B"
+        
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size_bytes < 1024.0:
+            return f"{size_bytes:.1f} {unit}"
+        size_bytes /= 1024.0
+    return f"{size_bytes:.1f} TB"
+
+def format_save_date(save_date, fmt='%Y-%m-%d %H:%M:%S'):
+    """Format an epoch save date (stored in UTC)"""
+    return datetime.fromtimestamp(save_date, timezone.utc).strftime(fmt)
+
+@dataclass(slots=True)
+class MediaRecord:
+    """One saved media item, shared by extraction, persistence and rendering"""
+    media_type: Optional[str] = None
+    file_id: Optional[str] = None
+    saved_filename: Optional[str] = None
+    file_path: Optional[str] = None
+    file_size: Optional[int] = None
+    original_filename: Optional[str] = None
+    mime_type: Optional[str] = None
+    duration: Optional[int] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    caption: Optional[str] = None
+    chat_id: Optional[int] = None
+    message_id: Optional[int] = None
+    user_id: Optional[int] = None
+    username: Optional[str] = None
+    user_first_name: Optional[str] = None
+    saved_by_user_id: Optional[int] = None
+    saved_by_username: Optional[str] = None
+    saved_by_first_name: Optional[str] = None
+    save_date: Optional[int] = None
+    size_text: Optional[str] = None
+    date_text: Optional[str] = None
+    id: Optional[int] = None
+    shard_id: Optional[int] = None
+    dhash: Optional[int] = None
+    variants: Optional[list] = None
+
+    @property
+    def media_key(self):
+        """Identity across shards, used by the caches and single-flight keys"""
+        return (self.shard_id, self.saved_filename)
+
+    @property
+    def short_date(self):
+        """'MM/DD HH:MM' sliced from the precomputed date_text"""
+        date_text = self.date_text
+        return f"{date_text[5:7]}/{date_text[8:10]} {date_text[11:16]}"
+
+@dataclass(frozen=True)
+class RetentionRule:
+    """Expire media older than max_age_days, optionally only of one type, sender or size range"""
+    max_age_days: float
+    media_type: Optional[str] = None
+    sender_id: Optional[int] = None
+    min_size: Optional[int] = None
+    max_size: Optional[int] = None
+
+    def where(self, now):
+        """SQL condition and parameters selecting the media this rule expires"""
+        conditions = ['save_date < ?']
+        params = [int(now - self.max_age_days * 86400)]
+        for sql, value in (
+            ('media_type = ?', self.media_type),
+            ('user_id = ?', self.sender_id),
+            ('file_size >= ?', self.min_size),
+            ('file_size <= ?', self.max_size)
+        ):
+            if value is not None:
+                conditions.append(sql)
+                params.append(value)
+        return ' AND '.join(conditions), params
+
+    def describe(self):
+        """Short human readable summary"""
+        parts = [f"{self.media_type}s" if self.media_type else "media"]
+        if self.sender_id is not None:
+            parts.append(f"from {self.sender_id}")
+        if self.min_size is not None:
+            parts.append(f"≥ {format_file_size(self.min_size)}")
+        if self.max_size is not None:
+            parts.append(f"≤ {format_file_size(self.max_size)}")
+        return f"{' '.join(parts)} after {self.max_age_days:g} days"
+
+def media_record_factory(cursor, row):
+    """sqlite3 row factory building MediaRecords from the selected columns"""
+    return MediaRecord(**{column[0]: value for column, value in zip(cursor.description, row)})
+
+def media_record_statements(record):
+    """SQL statements storing a media record, its users and its photo hash"""
+    statements = []
+    
+    # Upsert sender and saver into the users table
+    for user_id, username, first_name in (
+        (record.user_id, record.username, record.user_first_name),
+        (record.saved_by_user_id, record.saved_by_username, record.saved_by_first_name)
+    ):
+        if user_id is not None:
+            statements.append(('''
+                INSERT INTO users (user_id, username, first_name) VALUES (?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    username = excluded.username,
+                    first_name = COALESCE(excluded.first_name, users.first_name)
+            ''', (user_id, username, first_name)))
+    
+    statements.append(('''
+        INSERT OR REPLACE INTO saved_media (
+            file_id, media_type, original_filename, saved_filename, file_path,
+            file_size, user_id, chat_id, message_id, caption, save_date,
+            saved_by_user_id, mime_type, duration, width, height, size_text, date_text
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        record.file_id,
+        record.media_type,
+        record.original_filename,
+        record.saved_filename,
+        record.file_path,
+        record.file_size,
+        record.user_id,
+        record.chat_id,
+        record.message_id,
+        record.caption,
+        record.save_date,
+        record.saved_by_user_id,
+        record.mime_type,
+        record.duration,
+        record.width,
+        record.height,
+        record.size_text,
+        record.date_text
+    )))
+    
+    statements += variant_statements(record.variants or (), 'file_id', record.file_id)
+    
+    if record.dhash is not None:
+        statements.append(('''
+            INSERT OR REPLACE INTO photo_hashes (media_id, dhash, b0, b1, b2, b3)
+            SELECT id, ?, ?, ?, ?, ? FROM saved_media WHERE file_id = ?
+        ''', (to_signed64(record.dhash), *dhash_bands(record.dhash), record.file_id)))
+    
+    return statements
+
+def variant_statements(variants, key_column, key):
+    """SQL statements recording image variants for the media whose key_column equals key"""
+    return [(f'''
+        INSERT OR REPLACE INTO media_variants (media_id, variant, file_path, file_size, width, height)
+        SELECT id, ?, ?, ?, ?, ? FROM saved_media WHERE {key_column} = ?
+    ''', (*variant, key)) for variant in variants]
+
+def compute_dhash(path):
+    """64-bit difference hash of an image (runs in a worker process)"""
+    with Image.open(path) as image:
+        pixels = np.asarray(image.convert('L').resize((9, 8), Image.Resampling.LANCZOS), dtype=np.int16)
+    bits = np.packbits(pixels[:, 1:] > pixels[:, :-1])
+    return int.from_bytes(bits.tobytes(), 'big')
+
+def make_image_variants(path, targets):
+    """Resized, recompressed copies of an image (runs in a worker process)
+    
+    targets are (variant, output path, max side, format, quality); returns
+    (variant, output path, size, width, height) for each copy that came out
+    smaller than the original.
+    """
+    original_size = os.path.getsize(path)
+    variants = []
+    with Image.open(path) as image:
+        # First frame only for animated GIFs
+        image = image.convert('RGB')
+        for variant, output_path, max_side, image_format, quality in targets:
+            copy = image.copy()
+            copy.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+            Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+            copy.save(output_path, image_format, quality=quality, optimize=True)
+            size = os.path.getsize(output_path)
+            if size >= original_size:
+                os.unlink(output_path)
+                continue
+            variants.append((variant, str(output_path), size, copy.width, copy.height))
+    return variants
+
+def hash_media_file(path, media_type):
+    """Content hash, size and photo dHash of a file (runs in a worker process)"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as media_file:
+        while chunk := media_file.read(1 << 20):
+            digest.update(chunk)
+    dhash = None
+    if media_type == 'photo' and np is not None and Image is not None:
+        try:
+            dhash = compute_dhash(path)
+        except Exception:
+            pass
+    stat = os.stat(path)
+    return digest.hexdigest(), stat.st_size, int(stat.st_mtime), dhash
+
+def dhash_bands(dhash):
+    """Split a 64-bit hash into the four 16-bit bands that are indexed"""
+    return [(dhash >> shift) & 0xFFFF for shift in (48, 32, 16, 0)]
+
+def hamming_distance(a, b):
+    """Number of differing bits between two 64-bit hashes"""
+    return ((a ^ b) & 0xFFFFFFFFFFFFFFFF).bit_count()
+
+def to_signed64(value):
+    """SQLite integers are signed 64-bit"""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+class NearDuplicateError(Exception):
+    """A photo was skipped because it near-duplicates an already saved one"""
+
+    def __init__(self, saved_filename, distance):
+        super().__init__(f"near-duplicate of {saved_filename} (distance {distance})")
+        self.saved_filename = saved_filename
+        self.distance = distance
+
+def migrate_v1(conn):
+    """Original schema: one wide row per saved media"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS saved_media (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_id TEXT UNIQUE NOT NULL,
+            media_type TEXT NOT NULL,
+            original_filename TEXT,
+            saved_filename TEXT,
+            file_path TEXT,
+            file_size INTEGER,
+            user_id INTEGER,
+            username TEXT,
+            user_first_name TEXT,
+            chat_id INTEGER,
+            message_id INTEGER,
+            caption TEXT,
+            save_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            saved_by_user_id INTEGER,
+            saved_by_username TEXT,
+            mime_type TEXT,
+            duration INTEGER,
+            width INTEGER,
+            height INTEGER
+        )
+    ''')
+
+def migrate_v2(conn):
+    """Integer epoch save dates, normalized users and covering indexes"""
+    conn.execute('''
+        CREATE TABLE users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT
+        )
+    ''')
+    
+    # Savers only carry a username; senders (newest row wins) also carry a first name
+    conn.execute('''
+        INSERT INTO users (user_id, username)
+        SELECT saved_by_user_id, saved_by_username FROM saved_media
+        WHERE saved_by_user_id IS NOT NULL ORDER BY id
+        ON CONFLICT(user_id) DO UPDATE SET username = excluded.username
+    ''')
+    conn.execute('''
+        INSERT INTO users (user_id, username, first_name)
+        SELECT user_id, username, user_first_name FROM saved_media
+        WHERE user_id IS NOT NULL ORDER BY id
+        ON CONFLICT(user_id) DO UPDATE SET
+            username = excluded.username,
+            first_name = excluded.first_name
+    ''')
+    
+    conn.execute('''
+        CREATE TABLE saved_media_v2 (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_id TEXT UNIQUE NOT NULL,
+            media_type TEXT NOT NULL,
+            original_filename TEXT,
+            saved_filename TEXT,
+            file_path TEXT,
+            file_size INTEGER,
+            user_id INTEGER REFERENCES users(user_id),
+            chat_id INTEGER,
+            message_id INTEGER,
+            caption TEXT,
+            save_date INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+            saved_by_user_id INTEGER REFERENCES users(user_id),
+            mime_type TEXT,
+            duration INTEGER,
+            width INTEGER,
+            height INTEGER
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO saved_media_v2 (
+            id, file_id, media_type, original_filename, saved_filename, file_path,
+            file_size, user_id, chat_id, message_id, caption, save_date,
+            saved_by_user_id, mime_type, duration, width, height
+        )
+        SELECT
+            id, file_id, media_type, original_filename, saved_filename, file_path,
+            file_size, user_id, chat_id, message_id, caption,
+            COALESCE(CAST(strftime('%s', save_date) AS INTEGER), CAST(strftime('%s', 'now') AS INTEGER)),
+            saved_by_user_id, mime_type, duration, width, height
+        FROM saved_media
+    ''')
+    conn.execute('DROP TABLE saved_media')
+    conn.execute('ALTER TABLE saved_media_v2 RENAME TO saved_media')
+    
+    # Covering indexes so listing, sorting and filename lookups never touch the table
+    conn.execute('''
+        CREATE INDEX idx_saved_media_type_date
+        ON saved_media (media_type, save_date, saved_filename, file_size, user_id)
+    ''')
+    conn.execute('''
+        CREATE INDEX idx_saved_media_date
+        ON saved_media (save_date, saved_filename, media_type, user_id)
+    ''')
+    conn.execute('''
+        CREATE INDEX idx_saved_media_filename
+        ON saved_media (saved_filename, save_date)
+    ''')
+
+def migrate_v3(conn):
+    """Display fields precomputed at save time so rendering does no formatting"""
+    conn.execute('ALTER TABLE saved_media ADD COLUMN size_text TEXT')
+    conn.execute('ALTER TABLE saved_media ADD COLUMN date_text TEXT')
+    
+    rows = conn.execute('SELECT id, file_size, save_date FROM saved_media').fetchall()
+    conn.executemany(
+        'UPDATE saved_media SET size_text = ?, date_text = ? WHERE id = ?',
+        [(format_file_size(file_size or 0), format_save_date(save_date), row_id) for row_id, file_size, save_date in rows]
+    )
+    
+    # Listing reads the date text too, keep it index-only
+    conn.execute('DROP INDEX idx_saved_media_date')
+    conn.execute('''
+        CREATE INDEX idx_saved_media_date
+        ON saved_media (save_date, saved_filename, media_type, user_id, date_text)
+    ''')
+
+def migrate_v4(conn):
+    """Perceptual photo hashes, split into bands for multi-index Hamming search"""
+    conn.execute('''
+        CREATE TABLE photo_hashes (
+            media_id INTEGER PRIMARY KEY,
+            dhash INTEGER NOT NULL,
+            b0 INTEGER NOT NULL,
+            b1 INTEGER NOT NULL,
+            b2 INTEGER NOT NULL,
+            b3 INTEGER NOT NULL
+        )
+    ''')
+    for band in range(4):
+        conn.execute(f'CREATE INDEX idx_photo_hashes_b{band} ON photo_hashes (b{band})')
+    conn.execute('''
+        CREATE TRIGGER saved_media_delete_hash AFTER DELETE ON saved_media
+        BEGIN
+            DELETE FROM photo_hashes WHERE media_id = OLD.id;
+        END
+    ''')
+
+def migrate_v5(conn):
+    """Change log of media rows so backups can sync files incrementally"""
+    conn.execute('''
+        CREATE TABLE change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            op TEXT NOT NULL,
+            media_id INTEGER NOT NULL,
+            file_path TEXT,
+            changed_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+        )
+    ''')
+    
+    # Existing media counts as inserted so the first sync copies everything
+    conn.execute('''
+        INSERT INTO change_log (op, media_id, file_path)
+        SELECT 'insert', id, file_path FROM saved_media ORDER BY id
+    ''')
+    conn.execute('''
+        CREATE TRIGGER saved_media_insert_log AFTER INSERT ON saved_media
+        BEGIN
+            INSERT INTO change_log (op, media_id, file_path) VALUES ('insert', NEW.id, NEW.file_path);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER saved_media_delete_log AFTER DELETE ON saved_media
+        BEGIN
+            INSERT INTO change_log (op, media_id, file_path) VALUES ('delete', OLD.id, OLD.file_path);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER saved_media_move_log AFTER UPDATE OF file_path ON saved_media
+        WHEN OLD.file_path IS NOT NEW.file_path
+        BEGIN
+            INSERT INTO change_log (op, media_id, file_path) VALUES ('delete', OLD.id, OLD.file_path);
+            INSERT INTO change_log (op, media_id, file_path) VALUES ('insert', NEW.id, NEW.file_path);
+        END
+    ''')
+
+def migrate_v6(conn):
+    """Derived image variants (thumbnails, recompressed previews) per media"""
+    conn.execute('''
+        CREATE TABLE media_variants (
+            media_id INTEGER NOT NULL,
+            variant TEXT NOT NULL,
+            file_path TEXT NOT NULL,
+            file_size INTEGER,
+            width INTEGER,
+            height INTEGER,
+            PRIMARY KEY (media_id, variant)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TRIGGER saved_media_delete_variants AFTER DELETE ON saved_media
+        BEGIN
+            DELETE FROM media_variants WHERE media_id = OLD.id;
+        END
+    ''')
+
+# Applied in order; PRAGMA user_version records how many have run
+MIGRATIONS = [migrate_v1, migrate_v2, migrate_v3, migrate_v4, migrate_v5, migrate_v6]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def migrate_database(db_path):
+    """Bring a database up to SCHEMA_VERSION, one transaction per migration"""
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise RuntimeError(f"Database schema v{version} is newer than this bot (v{SCHEMA_VERSION})")
+        
+        for target in range(version + 1, SCHEMA_VERSION + 1):
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                MIGRATIONS[target - 1](conn)
+                conn.execute(f'PRAGMA user_version = {target}')
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            logger.info("Database migrated to schema v%s", target)
+    finally:
+        conn.close()
+
+class MediaShard:
+    """One archive partition with its own database, writer and media root"""
+
+    def __init__(self, shard_id, base_dir):
+        self.shard_id = shard_id
+        self.base_dir = Path(base_dir)
+        self.db_path = self.base_dir / "saved_media.db"
+        self.media_dirs = {media_type: self.base_dir / subdir for media_type, subdir in MEDIA_SUBDIRS.items()}
+        self.writer = None
+
+    def prepare(self):
+        """Create directories and migrate the database"""
+        for directory in self.media_dirs.values():
+            directory.mkdir(parents=True, exist_ok=True)
+        migrate_database(self.db_path)
+
+    def open(self):
+        """Prepare the shard and start the writer"""
+        self.prepare()
+        self.writer = WriteBehindBuffer(self.db_path)
+
+    def close(self):
+        """Flush and stop the writer"""
+        if self.writer:
+            self.writer.close()
+
+    def query(self, sql, params=()):
+        """Run a SELECT and return its rows as MediaRecords tagged with this shard"""
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = media_record_factory
+        try:
+            records = conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+        for record in records:
+            record.shard_id = self.shard_id
+        return records
+
+    def variant_path(self, variant, saved_filename):
+        """Where a variant of a saved media is stored"""
+        extension = VARIANT_EXTENSIONS.get(IMAGE_VARIANTS[variant]['format'], '.img')
+        # The full saved filename, so x.jpg and x.png don't share variants
+        return self.base_dir / "variants" / variant / f"{saved_filename}{extension}"
+
+    def variant_paths(self, saved_filename):
+        """Paths of every configured variant of a saved media"""
+        return [self.variant_path(variant, saved_filename) for variant in IMAGE_VARIANTS]
+
+    def variants_for(self, saved_filenames, variant):
+        """saved_filename -> (file_path, file_size) of one variant for the given media"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            rows = conn.execute(f'''
+                SELECT m.saved_filename, v.file_path, v.file_size
+                FROM media_variants v
+                JOIN saved_media m ON m.id = v.media_id
+                WHERE v.variant = ? AND m.saved_filename IN ({', '.join('?' * len(saved_filenames))})
+            ''', [variant, *saved_filenames]).fetchall()
+        finally:
+            conn.close()
+        return {saved_filename: (file_path, file_size) for saved_filename, file_path, file_size in rows}
+
+    def similar_photos(self, dhash, max_distance=NEAR_DUPLICATE_DISTANCE, limit=10):
+        """Saved photos within max_distance of a hash, nearest first, as (distance, record)
+        
+        By pigeonhole, two hashes at most 7 bits apart agree on one of the four
+        16-bit bands to within one bit, so probing each band and its 16
+        one-bit neighbours through the band indexes finds every match.
+        """
+        probes = []
+        for band in dhash_bands(dhash):
+            probes += [band] + [band ^ (1 << bit) for bit in range(16)]
+        placeholders = ', '.join('?' * 17)
+        candidates = self.query(f'''
+            SELECT m.id, m.saved_filename, m.media_type, m.size_text, m.date_text, h.dhash
+            FROM photo_hashes h
+            JOIN saved_media m ON m.id = h.media_id
+            WHERE h.b0 IN ({placeholders}) OR h.b1 IN ({placeholders})
+               OR h.b2 IN ({placeholders}) OR h.b3 IN ({placeholders})
+        ''', probes)
+        
+        matches = []
+        for record in candidates:
+            distance = hamming_distance(dhash, record.dhash)
+            if distance <= max_distance:
+                matches.append((distance, record))
+        matches.sort(key=lambda match: match[0])
+        return matches[:limit]
+
+class ShardRouter:
+    """Map log group chat ids to the shards that store their media"""
+
+    def __init__(self, root, group_ids, shard_count=None, owned=None):
+        self.root = Path(root)
+        self.group_ids = list(group_ids)
+        self.shard_count = shard_count
+        self.group_shards = {chat_id: self.shard_id_for(chat_id) for chat_id in self.group_ids}
+        self.shards = {
+            shard_id: MediaShard(shard_id, self.shard_dir(shard_id))
+            for shard_id in dict.fromkeys(self.group_shards.values())
+            if owned is None or shard_id in owned
+        }
+
+    def shard_id_for(self, chat_id):
+        """Stable shard id for a log group"""
+        if self.shard_count:
+            return zlib.crc32(str(chat_id).encode()) % self.shard_count
+        return chat_id
+
+    def shard_dir(self, shard_id):
+        """Media root of a shard"""
+        if self.shard_count:
+            return self.root / "shards" / f"{shard_id:02d}"
+        # The first group keeps the original single-database layout
+        if shard_id == self.group_ids[0]:
+            return self.root
+        return self.root / "groups" / str(shard_id)
+
+    def is_log_group(self, chat_id):
+        """Whether a chat is one of the configured log groups"""
+        return chat_id in self.group_shards
+
+    def shard_for(self, chat_id):
+        """Shard owned by this process for a log group, or None"""
+        return self.shards.get(self.group_shards.get(chat_id))
+
+    def shards_for(self, chat_id):
+        """Shards visible from a chat: its own inside a log group, all owned elsewhere"""
+        if self.is_log_group(chat_id):
+            shard = self.shard_for(chat_id)
+            return [shard] if shard else []
+        return list(self.shards.values())
+
+    def open(self):
+        """Open every owned shard"""
+        for shard in self.shards.values():
+            shard.open()
+
+    def close(self):
+        """Flush and close every owned shard"""
+        for shard in self.shards.values():
+            shard.close()
+
+class LoopWatchdog:
+    """Thread noticing event loop stalls and logging the stack that blocks the loop
+    
+    The loop bumps a heartbeat every interval; the thread only compares
+    timestamps, so a healthy loop pays one timer callback per interval.
+    """
+
+    def __init__(self, threshold=LOOP_LAG_THRESHOLD, interval=LOOP_WATCHDOG_INTERVAL):
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls = 0
+        self.max_lag = 0.0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="loop-watchdog", daemon=True)
+        self.handle = None
+
+    def start(self, loop):
+        """Start watching a running loop (call from the loop's thread)"""
+        self.loop = loop
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat()
+        self.thread.start()
+
+    def heartbeat(self):
+        """Record that the loop is responsive and schedule the next beat"""
+        self.beat = time.monotonic()
+        self.handle = self.loop.call_later(self.interval, self.heartbeat)
+
+    def stop(self):
+        """Stop the heartbeat and the watchdog thread"""
+        self.stopped.set()
+        if self.handle:
+            self.handle.cancel()
+
+    def run(self):
+        """Compare the heartbeat against the threshold until stopped"""
+        stalled_since = None
+        while not self.stopped.wait(self.interval):
+            lag = time.monotonic() - self.beat - self.interval
+            if lag > self.threshold and stalled_since is None:
+                stalled_since = self.beat
+                self.stalls += 1
+                frame = sys._current_frames().get(self.loop_thread_id)
+                stack = ''.join(traceback.format_stack(frame)) if frame else "(no frame)\n"
+                logger.warning("Event loop blocked for %.2fs, currently running:\n%s", lag, stack.rstrip())
+            elif stalled_since is not None and lag <= self.threshold:
+                stall = self.beat - stalled_since
+                self.max_lag = max(self.max_lag, stall)
+                logger.warning("Event loop recovered after a %.2fs stall", stall)
+                stalled_since = None
+
+class SamplingProfiler:
+    """Sample every thread's stack at a fixed interval and fold them for flame graphs"""
+
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="sampling-profiler", daemon=True)
+
+    def start(self):
+        """Start sampling in the background"""
+        self.thread.start()
+
+    def stop(self):
+        """Stop sampling and wait for the sampler to finish"""
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        """Take a sample of every other thread each interval until stopped"""
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[';'.join(name.replace(';', ':') for name in reversed(stack))] += 1
+            self.samples += 1
+
+    def folded(self):
+        """Collapsed stacks ("root;...;leaf count" lines) for flamegraph.pl or speedscope"""
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+class RenderCache:
+    """LRU cache of rendered captions and list pages
+    
+    Keys start with the saved filename they render, or None for pages that
+    may list any media, so a save or delete only drops what it can affect.
+    """
+
+    def __init__(self, maxsize=RENDER_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        # Warm start: key -> value or None from a catalog snapshot, consulted on misses
+        self.fallback = None
+        self.blocked = set()
+
+    def get(self, key):
+        """Return a cached rendering (refreshing its recency) or None"""
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        elif self.fallback is not None and key[0] not in self.blocked:
+            value = self.fallback(key)
+            if value is not None:
+                self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        """Cache a rendering, evicting the least recently used entry when full"""
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, saved_filename):
+        """Drop all pages plus the entries rendered for one media"""
+        for key in [key for key in self.entries if key[0] is None or key[0] == saved_filename]:
+            del self.entries[key]
+        if self.fallback is not None:
+            self.blocked.update((None, saved_filename))
+
+    def clear(self):
+        """Drop everything, including the snapshot fallback"""
+        self.entries.clear()
+        self.fallback = None
+
+class WarmDict(dict):
+    """Dict that fills misses from a snapshot fallback until a key is popped or the dict cleared"""
+
+    def __init__(self):
+        super().__init__()
+        self.fallback = None
+        self.blocked = set()
+
+    def __missing__(self, key):
+        if self.fallback is None or key in self.blocked:
+            raise KeyError(key)
+        value = self.fallback(key)
+        if value is None:
+            raise KeyError(key)
+        self[key] = value
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def pop(self, key, *default):
+        if self.fallback is not None:
+            self.blocked.add(key)
+        return super().pop(key, *default)
+
+    def clear(self):
+        super().clear()
+        self.fallback = None
+
+class CatalogSnapshot:
+    """Read-only, memory-mapped snapshot of cache sections keyed by JSON-encoded keys
+    
+    Layout: magic, header length, JSON header, then per section a sorted index
+    of (key hash, offset, length) entries followed by the entries themselves
+    (key length, key JSON, value JSON). Opening parses only the header; a
+    lookup binary-searches the index and decodes one value.
+    """
+
+    MAGIC = b"MIDEASN1"
+    FORMAT = 1
+    PREFIX = struct.Struct('<8sI')
+    INDEX_ENTRY = struct.Struct('<QQI')
+    KEY_LENGTH = struct.Struct('<I')
+
+    def __init__(self, path, file, mapping, header):
+        self.path = path
+        self.file = file
+        self.mapping = mapping
+        self.header = header
+        self.data_start = self.PREFIX.size + header['length']
+
+    @classmethod
+    def open(cls, path):
+        """Map a snapshot, or return None if it is missing, corrupt or from another format"""
+        try:
+            file = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        try:
+            mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, length = cls.PREFIX.unpack_from(mapping)
+            if magic != cls.MAGIC:
+                raise ValueError("bad magic")
+            header = json.loads(mapping[cls.PREFIX.size:cls.PREFIX.size + length])
+            if header.get('format') != cls.FORMAT:
+                raise ValueError(f"format {header.get('format')}")
+            header['length'] = length
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning("Ignoring catalog snapshot %s: %s", path, e)
+            file.close()
+            return None
+        return cls(path, file, mapping, header)
+
+    @staticmethod
+    def encode_key(key):
+        return json.dumps(key, separators=(',', ':')).encode()
+
+    @staticmethod
+    def key_hash(encoded):
+        return int.from_bytes(hashlib.blake2b(encoded, digest_size=8).digest(), 'little')
+
+    @staticmethod
+    def freeze(value):
+        """JSON arrays back to the tuples used as cache keys"""
+        if isinstance(value, list):
+            return tuple(CatalogSnapshot.freeze(item) for item in value)
+        return value
+
+    def entry(self, offset, length):
+        """(key bytes, value bytes) stored at a data offset"""
+        start = self.data_start + offset
+        (key_length,) = self.KEY_LENGTH.unpack_from(self.mapping, start)
+        key_start = start + self.KEY_LENGTH.size
+        return (
+            self.mapping[key_start:key_start + key_length],
+            self.mapping[key_start + key_length:start + length]
+        )
+
+    def get(self, section, key):
+        """Decoded value stored for key, or None"""
+        info = self.header['sections'].get(section)
+        if not info:
+            return None
+        encoded = self.encode_key(key)
+        wanted = self.key_hash(encoded)
+        
+        # Leftmost index entry whose hash is >= wanted
+        index = self.data_start + info['index']
+        low, high = 0, info['count']
+        while low < high:
+            middle = (low + high) // 2
+            if self.INDEX_ENTRY.unpack_from(self.mapping, index + middle * self.INDEX_ENTRY.size)[0] < wanted:
+                low = middle + 1
+            else:
+                high = middle
+        
+        for position in range(low, info['count']):
+            entry_hash, offset, length = self.INDEX_ENTRY.unpack_from(self.mapping, index + position * self.INDEX_ENTRY.size)
+            if entry_hash != wanted:
+                break
+            entry_key, value = self.entry(offset, length)
+            if entry_key == encoded:
+                return json.loads(value)
+        return None
+
+    def items(self, section):
+        """Every (key, value) of a section, keys as tuples"""
+        info = self.header['sections'].get(section)
+        if not info:
+            return
+        index = self.data_start + info['index']
+        for position in range(info['count']):
+            _, offset, length = self.INDEX_ENTRY.unpack_from(self.mapping, index + position * self.INDEX_ENTRY.size)
+            key, value = self.entry(offset, length)
+            yield self.freeze(json.loads(key)), json.loads(value)
+
+    def close(self):
+        self.mapping.close()
+        self.file.close()
+
+    @classmethod
+    def write(cls, path, header, sections):
+        """Atomically write sections ({name: iterable of (key, value)}) and a header"""
+        body = io.BytesIO()
+        header = dict(header, format=cls.FORMAT, sections={})
+        for name, items in sections.items():
+            entries = []
+            for key, value in items:
+                encoded = cls.encode_key(key)
+                offset = body.tell()
+                body.write(cls.KEY_LENGTH.pack(len(encoded)))
+                body.write(encoded)
+                body.write(json.dumps(value, separators=(',', ':')).encode())
+                entries.append((cls.key_hash(encoded), offset, body.tell() - offset))
+            entries.sort()
+            header['sections'][name] = {'index': body.tell(), 'count': len(entries)}
+            for entry in entries:
+                body.write(cls.INDEX_ENTRY.pack(*entry))
+        
+        encoded_header = json.dumps(header).encode()
+        temp_path = path.with_name(f"{path.name}.tmp")
+        with open(temp_path, 'wb') as f:
+            f.write(cls.PREFIX.pack(cls.MAGIC, len(encoded_header)))
+            f.write(encoded_header)
+            f.write(body.getbuffer())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+        return len(encoded_header) + body.tell()
+
+class SingleFlight:
+    """Coalesce concurrent calls sharing a key into one in-flight task"""
 
-class ReplySaveBot:
     def __init__(self):
-        self.application = Application.builder().token(BOT_TOKEN).build()
+        self.calls = {}
+
+    async def do(self, key, func, *args):
+        """Run func(*args) once per key; concurrent callers await the same result"""
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args))
+            self.calls[key] = task
+            task.add_done_callback(lambda done: self.forget(key, done))
+        # Shield so one cancelled caller doesn't cancel the shared task
+        return await asyncio.shield(task)
+
+    def forget(self, key, task):
+        """Drop a finished task so the next call starts fresh"""
+        if self.calls.get(key) is task:
+            del self.calls[key]
+
+class RateLimiter:
+    """Space calls evenly so concurrent senders together stay under a rate"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_slot = 0.0
+
+    async def wait(self):
+        """Sleep until this caller's slot comes up"""
+        now = time.monotonic()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+class WriteBehindBuffer:
+    """Group-commit database writes on a background thread"""
+    
+    STOP = object()
+
+    def __init__(self, db_path, flush_interval_ms=WRITE_FLUSH_INTERVAL_MS, batch_size=WRITE_BATCH_SIZE):
+        self.db_path = db_path
+        self.flush_interval = flush_interval_ms / 1000
+        self.batch_size = batch_size
+        self.pending = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="write-behind", daemon=True)
+        self.thread.start()
+
+    def submit(self, sql, params=()):
+        """Queue a write; the returned future resolves with its rowcount once committed"""
+        return self.submit_all([(sql, params)])
+
+    def submit_all(self, statements):
+        """Queue several statements that succeed or fail together"""
+        future = concurrent.futures.Future()
+        self.pending.put((statements, future))
+        return future
+
+    def flush(self):
+        """Return a future that resolves once everything queued so far is committed"""
+        return self.submit_all([])
+
+    def close(self):
+        """Commit pending writes and stop the writer thread"""
+        if self.thread.is_alive():
+            self.pending.put(self.STOP)
+            self.thread.join()
+
+    def run(self):
+        """Collect writes into batches and commit each batch in one transaction"""
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
+        # WAL lets readers keep going while a batch commits
+        conn.execute('PRAGMA journal_mode=WAL')
+        # Rows removed by INSERT OR REPLACE must fire the delete triggers (change_log, hashes, variants)
+        conn.execute('PRAGMA recursive_triggers=ON')
+        stopping = False
+        
+        while not stopping:
+            item = self.pending.get()
+            if item is self.STOP:
+                break
+            
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.pending.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is self.STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            
+            self.commit(conn, batch)
+        
+        conn.close()
+
+    def commit(self, conn, batch):
+        """Apply a batch in one transaction, isolating failures per write"""
+        # Running futures can't be cancelled any more; ones cancelled while queued
+        # still get their write committed (the caller may already have written
+        # the media file), only the result goes nowhere
+        for _, future in batch:
+            future.set_running_or_notify_cancel()
+        
+        results = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for statements, future in batch:
+                # A savepoint per write keeps one bad row from failing the whole batch
+                conn.execute('SAVEPOINT write')
+                try:
+                    rowcount = sum(conn.execute(sql, params).rowcount for sql, params in statements)
+                    conn.execute('RELEASE write')
+                    results.append((future, rowcount, None))
+                except sqlite3.Error as e:
+                    conn.execute('ROLLBACK TO write')
+                    conn.execute('RELEASE write')
+                    results.append((future, None, e))
+            conn.execute('COMMIT')
+        except Exception as e:
+            logger.error("Write batch of %s failed: %s", len(batch), e)
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            for _, future in batch:
+                self.settle(future, None, e)
+            return
+        
+        for future, rowcount, error in results:
+            self.settle(future, rowcount, error)
+
+    @staticmethod
+    def settle(future, result, error):
+        """Resolve a write's future; a future that can't take it must not kill the writer thread"""
+        if future.cancelled():
+            return
+        try:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        except concurrent.futures.InvalidStateError as e:
+            logger.warning("Write result dropped: %s", e)
+
+def sanitize_update(data, salt):
+    """Strip personal data from an update dict, keeping its shape for replay
+    
+    Users (any dict shaped like one, wherever it appears: senders, forward
+    origins, joined members), non-log chats and file ids become stable
+    pseudonyms (so albums, repeated senders and duplicate media still line
+    up), free text, captions and names become same-length filler, and
+    commands and filenames are kept.
+    """
+    def pseudonym(value, modulo=10 ** 9):
+        digest = hashlib.blake2b(f"{salt}:{value}".encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'big') % modulo + 1
+
+    def filler(text):
+        return ''.join(character if character in ' \n' else 'x' for character in text)
+
+    def clean(key, value):
+        if isinstance(value, list):
+            return [clean(key, item) for item in value]
+        if not isinstance(value, dict):
+            if key in ('file_id', 'file_unique_id'):
+                return f"f{pseudonym(value, 1 << 60):x}"
+            if key in ('caption', 'sender_user_name', 'author_signature'):
+                return filler(value)
+            if key == 'text':
+                # Commands and filename-like words drive handlers, anything else is chatter (or an address)
+                keep = value.startswith('/') or (' ' not in value and '.' in value and '@' not in value)
+                return value if keep else filler(value)
+            return value
+        
+        is_user = 'is_bot' in value or 'first_name' in value
+        is_chat = 'type' in value and 'id' in value and value['type'] in ('private', 'group', 'supergroup', 'channel')
+        if is_user or is_chat and value['type'] == 'private':
+            user_id = pseudonym(value['id'])
+            return {
+                **{name: item for name, item in value.items() if name in ('is_bot', 'type', 'language_code')},
+                'id': user_id,
+                'first_name': f"User{user_id % 10000}",
+                'username': f"user{user_id % 10000}"
+            }
+        if is_chat and value['id'] not in LOG_GROUP_IDS:
+            return {'id': -pseudonym(value['id']), 'type': value.get('type'), 'title': "Chat"}
+        return {
+            name: clean(name, item) for name, item in value.items()
+            if name not in ('contact', 'location', 'venue', 'caption_entities', 'phone_number', 'email', 'last_name', 'bio')
+        }
+    
+    return clean(None, data)
+
+class UpdateRecorder:
+    """Append sanitized incoming updates with arrival offsets to a JSON Lines file"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.salt = os.urandom(16).hex()  # never stored, pseudonyms can't be reversed
+        self.started = time.monotonic()
+
+    async def record(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handler (group -1) that writes every update before the real handlers run"""
+        self.file.write(json.dumps({
+            'offset': round(time.monotonic() - self.started, 3),
+            'update': sanitize_update(update.to_dict(), self.salt)
+        }) + "\n")
+
+    def close(self):
+        """Flush and close the recording"""
+        self.file.close()
+
+class ReplySaveBot:
+    def __init__(self, request=None, media_root=MEDIA_ROOT):
+        builder = Application.builder().token(BOT_TOKEN).post_init(self.post_init).post_shutdown(self.post_shutdown)
+        if request is not None:
+            # Load tests swap in a fake Bot API transport
+            builder.request(request).get_updates_request(request)
+        self.application = builder.build()
+        self.media_root = media_root
         self.setup_storage()
         self.setup_database()  # Fixed: Added this line
         self.setup_handlers()
         
-    def setup_storage(self):
-        """Setup storage directories and database"""
-        # Create media directories
-        self.base_dir = Path("saved_media")
-        self.media_dirs = {
-            'video': self.base_dir / "videos",
-            'photo': self.base_dir / "photos",
-            'audio': self.base_dir / "audio",
-            'voice': self.base_dir / "voice",
-            'video_note': self.base_dir / "video_notes",
-            'document': self.base_dir / "documents",
-            'animation': self.base_dir / "animations"
-        }
+        # Single-flight coalescing of lookups/uploads and reusable Telegram file_ids
+        self.inflight = SingleFlight()
+        self.sent_file_ids = WarmDict()
         
-        # Create all directories
-        for directory in self.media_dirs.values():
-            directory.mkdir(parents=True, exist_ok=True)
+        # Rendered captions and list pages, invalidated on save and delete
+        self.render_cache = RenderCache()
+        
+        # Recently seen media per log group: message_id -> (record, media_group_id, timestamp)
+        self.recent_media = {}
+        self.reserved_paths = set()
+        
+        # Worker processes for perceptual hashing, started on first use
+        self.hash_pool = None
+        
+        # Diagnostics: loop stall watchdog (started with the loop) and /profile sampler
+        self.watchdog = LoopWatchdog(LOOP_LAG_THRESHOLD) if LOOP_LAG_THRESHOLD else None
+        self.profiler = None
+        
+        # Scheduled expiry and its counters
+        self.retention_rules = [RetentionRule(**rule) for rule in RETENTION_RULES]
+        self.metrics = Counter()
+        self.setup_retention()
+        
+        # Warm start from the last catalog snapshot, opened once the loop runs
+        self.snapshot = None
+        self.snapshot_stale = {}
+        self.snapshot_path = self.media_root / SNAPSHOT_FILE if SNAPSHOT_FILE else None
+        self.snapshot_task = None
+        self.snapshot_lock = threading.Lock()
+        
+    def setup_storage(self):
+        """Setup storage directories for every shard served by this process"""
+        self.router = ShardRouter(self.media_root, LOG_GROUP_IDS, SHARD_COUNT, OWNED_SHARDS)
         
     def setup_database(self):
         """Setup SQLite database for saved media tracking"""
-        self.db_path = self.base_dir / "saved_media.db"
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS saved_media (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                file_id TEXT UNIQUE NOT NULL,
-                media_type TEXT NOT NULL,
-                original_filename TEXT,
-                saved_filename TEXT,
-                file_path TEXT,
-                file_size INTEGER,
-                user_id INTEGER,
-                username TEXT,
-                user_first_name TEXT,
-                chat_id INTEGER,
-                message_id INTEGER,
-                caption TEXT,
-                save_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                saved_by_user_id INTEGER,
-                saved_by_username TEXT,
-                mime_type TEXT,
-                duration INTEGER,
-                width INTEGER,
-                height INTEGER
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
-        logger.info("Database setup complete")
+        # Each shard migrates its own database and starts its own group-commit writer
+        self.router.open()
+        logger.info("Database setup complete (%s shards)", len(self.router.shards))
         
     def setup_handlers(self):
-        """Setup command handlers"""
+        """Setup command handlers
+        
+        Updates are processed one at a time, so read-only retrieval handlers
+        use block=False: a slow send doesn't hold up other chats, and
+        identical concurrent requests meet in the single-flight layer.
+        """
         # Save command handler (only works as reply)
         self.application.add_handler(
             CommandHandler("save", self.save_command, filters=filters.REPLY)
@@ -86,22 +1409,22 @@ class ReplySaveBot:
         
         # Get media command
         self.application.add_handler(
-            CommandHandler("get", self.get_command)
+            CommandHandler("get", self.get_command, block=False)
         )
         
         # Stats command
         self.application.add_handler(
-            CommandHandler("stats", self.stats_command)
+            CommandHandler("stats", self.stats_command, block=False)
         )
         
         # List saved media command
         self.application.add_handler(
-            CommandHandler("list", self.list_command)
+            CommandHandler("list", self.list_command, block=False)
         )
         
         # Search command
         self.application.add_handler(
-            CommandHandler("search", self.search_command)
+            CommandHandler("search", self.search_command, block=False)
         )
         
         # Delete command
@@ -116,30 +1439,96 @@ class ReplySaveBot:
         
         # Start command
         self.application.add_handler(
-            CommandHandler("start", self.start_command)
+            CommandHandler("start", self.start_command, block=False)
+        )
+        
+        # Compact preview of a saved image
+        self.application.add_handler(
+            CommandHandler("preview", self.preview_command, block=False)
+        )
+        
+        # Similar photos command
+        self.application.add_handler(
+            CommandHandler("similar", self.similar_command, block=False)
+        )
+        
+        # Save all media in a reply range or time window; batches take a while, so non-blocking
+        self.application.add_handler(
+            CommandHandler("saveall", self.save_all_command, block=False)
+        )
+        
+        # Retention rules and what they would expire
+        self.application.add_handler(
+            CommandHandler("retention", self.retention_command)
+        )
+        
+        # Sampling profiler for admins, non-blocking so it samples live traffic
+        self.application.add_handler(
+            CommandHandler("profile", self.profile_command, block=False)
+        )
+        
+        # Fan-out of saved media to many chats for admins; it can run for minutes
+        self.application.add_handler(
+            CommandHandler("broadcast", self.broadcast_command, block=False)
+        )
+        
+        # Remember media posted in log groups for /saveall and album saves
+        self.application.add_handler(
+            MessageHandler(
+                filters.Chat(LOG_GROUP_IDS) & (
+                    filters.PHOTO | filters.VIDEO | filters.AUDIO | filters.VOICE |
+                    filters.VIDEO_NOTE | filters.Document.ALL | filters.ANIMATION
+                ),
+                self.track_media_message
+            ),
+            group=1
         )
         
         # Message handler for media name requests (non-command messages)
         self.application.add_handler(
-            MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_media_request)
+            MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_media_request, block=False)
         )
+        
+        # Record sanitized traffic for load-test replay
+        self.recorder = UpdateRecorder(RECORD_UPDATES_FILE) if RECORD_UPDATES_FILE else None
+        if self.recorder:
+            self.application.add_handler(TypeHandler(Update, self.recorder.record), group=-1)
+        
+        # Log groups on shards served by another bot process are left entirely to that process
+        if any(self.router.shard_for(chat_id) is None for chat_id in self.router.group_ids):
+            self.application.add_handler(TypeHandler(Update, self.skip_foreign_group), group=-2)
+
+    async def skip_foreign_group(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Stop handling updates from log groups whose shard this process doesn't own"""
+        chat = update.effective_chat
+        if chat is not None and self.router.is_log_group(chat.id) and self.router.shard_for(chat.id) is None:
+            raise ApplicationHandlerStop
+
+    def setup_retention(self):
+        """Schedule periodic expiry when retention rules are configured"""
+        self.retention_scheduled = False
+        if not self.retention_rules:
+            return
+        if self.application.job_queue is None:
+            logger.warning('Retention rules need the JobQueue: pip install "python-telegram-bot[job-queue]"')
+            return
+        self.application.job_queue.run_repeating(
+            self.retention_job, interval=RETENTION_INTERVAL, first=60, name="retention"
+        )
+        self.retention_scheduled = True
 
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /start command - sends saved videos turn by turn"""
         try:
             # Get all saved videos in order
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                SELECT saved_filename, file_path, file_size, caption, user_first_name, save_date
-                FROM saved_media 
-                WHERE media_type = 'video'
-                ORDER BY save_date ASC
-            ''')
-            
-            videos = cursor.fetchall()
-            conn.close()
+            videos = self.query_media(self.router.shards_for(update.effective_chat.id), '''
+                SELECT m.saved_filename, m.file_path, m.media_type, m.caption,
+                       u.first_name AS user_first_name, m.save_date, m.size_text, m.date_text
+                FROM saved_media m
+                LEFT JOIN users u ON u.user_id = m.user_id
+                WHERE m.media_type = 'video'
+                ORDER BY m.save_date ASC
+            ''', newest_first=False)
             
             if not videos:
                 # If no videos, send welcome message
@@ -157,12 +1546,18 @@ class ReplySaveBot:
 
 📌 **Commands:**
 • `/save` - Save media (reply to media)
+• `/saveall` - Save every media from the replied one onward (or `/saveall 2h`)
 • `/get <filename>` - Get saved media by filename
+• `/preview <filename>` - Get a small preview of a saved photo or GIF
 • `/delete <filename>` - Delete specific saved media
 • `/deleteall` - Delete all saved media (confirmation required)
 • `/stats` - Show saved media statistics  
-• `/list` - List recent saved media
+• `/list` - List recent saved media (`/list grid` adds image thumbnails)
 • `/search <query>` - Search saved media
+• `/similar <filename>` - Find near-duplicates of a saved photo
+• `/retention` - Show retention rules and what they will expire
+• `/profile <seconds>` - Profile the bot and get a flame graph file (admins)
+• `/broadcast <filename|query> <chats>` - Send saved media to many chats (admins)
 
 🏷️ **Supported Media:**
 • Videos 📹
@@ -176,7 +1571,7 @@ class ReplySaveBot:
 💡 **Tips:**
 • Just send the filename (without path) to get media
 • Use partial filenames for search
-• The bot works in your log group: `{LOG_GROUP_ID}`
+• The bot works in your log groups: `{', '.join(str(chat_id) for chat_id in LOG_GROUP_IDS)}`
 
 ❌ **No videos saved yet!** Use /save command to save videos first.
                 """
@@ -191,55 +1586,47 @@ class ReplySaveBot:
             )
             
             # Send each video turn by turn
-            for index, (saved_filename, file_path, file_size, caption, sender, save_date) in enumerate(videos, 1):
+            for index, video in enumerate(videos, 1):
                 try:
                     # Check if file exists
-                    if not Path(file_path).exists():
+                    if not Path(video.file_path).exists():
                         await update.message.reply_text(
-                            f"❌ **Video {index} not found:** `{saved_filename}`",
+                            f"❌ **Video {index} not found:** `{video.saved_filename}`",
                             parse_mode='Markdown'
                         )
                         continue
                     
-                    # Send typing action
-                    await context.bot.send_chat_action(
-                        chat_id=update.effective_chat.id,
-                        action='upload_video'
-                    )
-                    
-                    # Prepare video info
-                    date_obj = datetime.fromisoformat(save_date.replace('Z', '+00:00'))
-                    info_text = (
-                        f"📹 **Video {index}/{len(videos)}**\n"
-                        f"📁 {saved_filename}\n"
-                        f"📊 Size: {self.format_file_size(file_size or 0)}\n"
-                        f"👤 Original Sender: {sender or 'Unknown'}\n"
-                        f"📅 Saved: {date_obj.strftime('%Y-%m-%d %H:%M:%S')}"
-                    )
-                    
-                    if caption:
-                        info_text += f"\n💬 Caption: {caption}"
-                    
-                    # Send the video
-                    with open(file_path, 'rb') as video_file:
-                        await context.bot.send_video(
-                            chat_id=update.effective_chat.id,
-                            video=video_file,
-                            caption=info_text,
-                            parse_mode='Markdown'
+                    # Prepare video info
+                    key = (None, 'start', video.media_key, index, len(videos), SCHEMA_VERSION)
+                    info_text = self.render_cache.get(key)
+                    if info_text is None:
+                        info_text = (
+                            f"📹 **Video {index}/{len(videos)}**\n"
+                            f"📁 {video.saved_filename}\n"
+                            f"📊 Size: {video.size_text}\n"
+                            f"👤 Original Sender: {video.user_first_name or 'Unknown'}\n"
+                            f"📅 Saved: {video.date_text}"
                         )
+                        
+                        if video.caption:
+                            info_text += f"\n💬 Caption: {video.caption}"
+                        self.render_cache.put(key, info_text)
+                    
+                    # Send the video (reuses the file_id once it has been uploaded)
+                    await self.deliver_media(
+                        context, update.effective_chat.id, video, info_text, action='upload_video'
+                    )
                     
-                    logger.info(f"Sent video {index}: {saved_filename} to user {update.effective_user.id}")
+                    logger.info("Sent video %s: %s to user %s", index, video.saved_filename, update.effective_user.id)
                     
                     # Small delay between videos to avoid flooding
                     if index < len(videos):  # Don't delay after the last video
-                        import asyncio
                         await asyncio.sleep(1)
                         
                 except Exception as e:
-                    logger.error(f"Error sending video {saved_filename}: {e}")
+                    logger.error("Error sending video %s: %s", video.saved_filename, e)
                     await update.message.reply_text(
-                        f"❌ **Error sending video {index}:** `{saved_filename}`",
+                        f"❌ **Error sending video {index}:** `{video.saved_filename}`",
                         parse_mode='Markdown'
                     )
                     continue
@@ -252,7 +1639,7 @@ class ReplySaveBot:
             )
             
         except Exception as e:
-            logger.error(f"Error in start command: {e}")
+            logger.error("Error in start command: %s", e)
             await update.message.reply_text(
                 "❌ **Error retrieving videos.** Please try again or contact support.",
                 parse_mode='Markdown'
@@ -260,12 +1647,17 @@ class ReplySaveBot:
 
     async def save_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /save command - only works as reply to media"""
-        # Check if it's in the log group
-        if update.effective_chat.id != LOG_GROUP_ID:
+        # Check if it's in a log group
+        if not self.router.is_log_group(update.effective_chat.id):
             await update.message.reply_text(
-                "❌ This command only works in the designated log group!"
+                "❌ This command only works in the designated log groups!"
             )
             return
+        
+        # Groups on shards served by another bot process are left to that process
+        shard = self.router.shard_for(update.effective_chat.id)
+        if shard is None:
+            return
             
         # Get the replied message
         replied_message = update.message.reply_to_message
@@ -277,33 +1669,41 @@ class ReplySaveBot:
             return
             
         # Check if the replied message contains media
-        media_info = self.extract_media_info(replied_message)
+        record = self.extract_media_info(replied_message)
         
-        if not media_info:
+        if not record:
             await update.message.reply_text(
                 "❌ The replied message doesn't contain any saveable media!"
             )
             return
             
+        # Replying to one item of an album saves the whole album
+        album = self.album_records(update.effective_chat.id, replied_message, record)
+        if len(album) > 1:
+            await self.save_batch(update, context, shard, album)
+            return
+            
         # Add save information
-        media_info['saved_by_user_id'] = update.effective_user.id
-        media_info['saved_by_username'] = update.effective_user.username
-        media_info['save_message_id'] = update.message.message_id
+        self.set_saved_by(record, update.effective_user)
         
         # Save the media
-        saved_path = await self.save_media(context, replied_message, media_info)
+        try:
+            saved_path = await self.save_record(context, shard, record)
+        except NearDuplicateError as e:
+            await update.message.reply_text(
+                f"⏭️ **Skipped:** this photo is a near-duplicate of `{e.saved_filename}` (distance {e.distance})",
+                parse_mode='Markdown'
+            )
+            return
         
         if saved_path:
-            # Save to database
-            self.save_to_database(media_info)
-            
             # Send confirmation
             await update.message.reply_text(
                 f"✅ **Media Saved Successfully!**\n\n"
                 f"📁 **File:** `{saved_path.name}`\n"
-                f"📂 **Type:** {media_info['media_type'].title()}\n"
-                f"📊 **Size:** {self.format_file_size(media_info.get('file_size', 0))}\n"
-                f"👤 **Original Sender:** {media_info.get('user_first_name', 'Unknown')}\n"
+                f"📂 **Type:** {record.media_type.title()}\n"
+                f"📊 **Size:** {record.size_text}\n"
+                f"👤 **Original Sender:** {record.user_first_name or 'Unknown'}\n"
                 f"💾 **Saved By:** {update.effective_user.first_name}\n"
                 f"📅 **Date:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
                 f"💡 **To retrieve:** Send `{saved_path.name}` or use `/get {saved_path.name}`\n"
@@ -315,6 +1715,287 @@ class ReplySaveBot:
                 "❌ Failed to save media. Please try again."
             )
 
+    async def save_all_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /saveall - save every media in a reply range or time window"""
+        # Check if it's in a log group
+        if not self.router.is_log_group(update.effective_chat.id):
+            await update.message.reply_text(
+                "❌ This command only works in the designated log groups!"
+            )
+            return
+        
+        shard = self.router.shard_for(update.effective_chat.id)
+        if shard is None:
+            return
+        
+        seen = self.recent_media.get(update.effective_chat.id, {})
+        replied_message = update.message.reply_to_message
+        window = self.parse_window(context.args[0]) if context.args else None
+        
+        if replied_message:
+            # Everything from the replied message up to this command
+            first, last = replied_message.message_id, update.message.message_id
+            records = [record for message_id, (record, _, _) in seen.items() if first <= message_id <= last]
+            if replied_message.message_id not in seen:
+                record = self.extract_media_info(replied_message)
+                if record:
+                    records.insert(0, record)
+        elif window:
+            since = time.time() - window
+            records = [record for record, _, seen_at in seen.values() if seen_at >= since]
+        else:
+            await update.message.reply_text(
+                "📦 **Usage:**\n"
+                "• Reply to the first media with `/saveall` to save everything up to here\n"
+                "• `/saveall 2h` to save media posted in the last 2 hours (`s`, `m`, `h`, `d`)\n\n"
+                "💡 Albums are saved whole when you `/save` any of their items",
+                parse_mode='Markdown'
+            )
+            return
+        
+        if not records:
+            await update.message.reply_text(
+                "❌ No media seen in that range. Only media posted while the bot is running can be batch saved."
+            )
+            return
+        
+        await self.save_batch(update, context, shard, records)
+
+    def parse_window(self, text):
+        """Parse a time window like 30m, 2h or 1d into seconds"""
+        units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+        text = text.strip().lower()
+        if len(text) < 2 or text[-1] not in units or not text[:-1].isdigit():
+            return None
+        return int(text[:-1]) * units[text[-1]]
+
+    async def track_media_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Remember media posted in a log group for batch and album saves"""
+        message = update.effective_message
+        record = self.extract_media_info(message)
+        if not record:
+            return
+        
+        seen = self.recent_media.setdefault(message.chat.id, OrderedDict())
+        seen[message.message_id] = (record, message.media_group_id, message.date.timestamp())
+        if len(seen) > RECENT_MEDIA_LIMIT:
+            seen.popitem(last=False)
+
+    def album_records(self, chat_id, message, record):
+        """All seen items of the album a message belongs to (just the record if none)"""
+        if not message.media_group_id:
+            return [record]
+        
+        seen = self.recent_media.get(chat_id, {})
+        album = {
+            message_id: album_record for message_id, (album_record, group_id, _) in seen.items()
+            if group_id == message.media_group_id
+        }
+        album.setdefault(message.message_id, record)
+        return [album[message_id] for message_id in sorted(album)]
+
+    def set_saved_by(self, record, user):
+        """Record who saved a media"""
+        record.saved_by_user_id = user.id
+        record.saved_by_username = user.username
+        record.saved_by_first_name = user.first_name
+
+    async def save_record(self, context, shard, record):
+        """Download one media and wait for its database commit
+        
+        /saveall runs alongside other updates, so a /save of the same media
+        joins the save already in flight instead of downloading it twice.
+        """
+        saved_path = await self.inflight.do(('save', shard.shard_id, record.file_id), self._save_record, context, shard, record)
+        if saved_path:
+            record.saved_filename = saved_path.name
+            record.file_path = str(saved_path)
+        return saved_path
+
+    async def _save_record(self, context, shard, record):
+        """Save one media: download, hash, make variants and commit its row"""
+        started = time.perf_counter()
+        saved_path = await self.save_media(context, shard, record)
+        if not saved_path:
+            return None
+        download_ms = (time.perf_counter() - started) * 1000
+        
+        # Hash photos at ingest; optionally drop ones that look like a saved photo
+        if record.media_type == 'photo':
+            record.dhash = await self.compute_photo_hash(saved_path)
+            if SKIP_NEAR_DUPLICATES and record.dhash is not None:
+                matches = await asyncio.to_thread(shard.similar_photos, record.dhash, limit=1)
+                if matches:
+                    saved_path.unlink(missing_ok=True)
+                    distance, match = matches[0]
+                    audit('save_skipped', shard=shard.shard_id, media_type=record.media_type,
+                          duplicate_of=match.saved_filename, distance=distance, bytes=record.file_size)
+                    raise NearDuplicateError(match.saved_filename, distance)
+        
+        record.variants = await self.make_variants(shard, record, saved_path)
+        
+        if await self.wait_for_write(self.save_to_database(shard, record)):
+            self.render_cache.invalidate(record.media_key)
+            audit('save', shard=shard.shard_id, file=record.saved_filename, media_type=record.media_type,
+                  bytes=record.file_size, chat_id=record.chat_id, user_id=record.saved_by_user_id,
+                  download_ms=round(download_ms, 1), duration_ms=round((time.perf_counter() - started) * 1000, 1))
+            return saved_path
+        return None
+
+    def image_pool(self):
+        """Worker processes for perceptual hashes and image variants"""
+        if self.hash_pool is None:
+            # Started after the writer, logging and to_thread threads exist, so never
+            # fork this process directly: children could inherit held locks
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            self.hash_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=HASH_WORKERS, mp_context=multiprocessing.get_context(method)
+            )
+        return self.hash_pool
+
+    async def make_variants(self, shard, record, path):
+        """Thumbnail and preview copies of a photo or GIF made in the process pool, None if unavailable"""
+        if not IMAGE_VARIANTS or Image is None or record.media_type not in VARIANT_MEDIA_TYPES:
+            return None
+        
+        targets = [
+            (variant, str(shard.variant_path(variant, record.saved_filename)), spec['max_side'], spec['format'], spec['quality'])
+            for variant, spec in IMAGE_VARIANTS.items()
+        ]
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.image_pool(), make_image_variants, str(path), targets)
+        except Exception as e:
+            # Most animations are MP4 and have no image to resize
+            logger.debug("No variants for %s: %s", path, e)
+            return None
+
+    async def variant_record(self, record, variant):
+        """Record for sending a variant of a media as a photo, made now if missing; None if there is none"""
+        shard = self.router.shards[record.shard_id]
+        found = (await asyncio.to_thread(shard.variants_for, [record.saved_filename], variant)).get(record.saved_filename)
+        if found is None or not Path(found[0]).exists():
+            # Media saved before variants were enabled, or restored from an export
+            # (which leaves variant files out), get them on first use; concurrent
+            # requests share one resize instead of writing the same files at once
+            variants = await self.inflight.do(
+                ('variants', record.media_key), self.make_variants, shard, record, record.file_path
+            )
+            if not variants:
+                return None
+            await self.wait_for_write(shard.writer.submit_all(variant_statements(variants, 'saved_filename', record.saved_filename)))
+            found = next(((file_path, file_size) for name, file_path, file_size, _, _ in variants if name == variant), None)
+            if found is None:
+                return None
+        
+        file_path, file_size = found
+        return replace(record, media_type='photo', file_path=file_path, file_size=file_size,
+                       saved_filename=f"{record.saved_filename}@{variant}")
+
+    def forget_media(self, record):
+        """Drop cached file_ids (original and variants) and renderings of a deleted media"""
+        self.sent_file_ids.pop(record.media_key, None)
+        for variant in IMAGE_VARIANTS:
+            self.sent_file_ids.pop((record.shard_id, f"{record.saved_filename}@{variant}"), None)
+        self.render_cache.invalidate(record.media_key)
+
+    async def compute_photo_hash(self, path):
+        """dHash of a saved photo computed in the process pool, None if unavailable"""
+        if np is None or Image is None:
+            return None
+        
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.image_pool(), compute_dhash, str(path))
+        except Exception as e:
+            logger.warning("Could not hash %s: %s", path, e)
+            return None
+
+    async def save_batch(self, update: Update, context: ContextTypes.DEFAULT_TYPE, shard, records):
+        """Save many media through a bounded parallel pipeline with one progress message"""
+        # Skip media already in this shard (file_id is unique)
+        existing = self.existing_file_ids(shard, [record.file_id for record in records])
+        pending = []
+        for record in records:
+            if record.file_id not in existing:
+                existing.add(record.file_id)
+                # Copy so the remembered record isn't mutated by the save
+                record = replace(record)
+                self.set_saved_by(record, update.effective_user)
+                pending.append(record)
+        skipped = len(records) - len(pending)
+        
+        if not pending:
+            await update.message.reply_text(f"✅ All {skipped} media in that range are already saved.")
+            return
+        
+        progress = await update.message.reply_text(
+            f"🔄 **Saving {len(pending)} media files...**",
+            parse_mode='Markdown'
+        )
+        
+        semaphore = asyncio.Semaphore(SAVE_CONCURRENCY)
+        saved = []
+        failed = 0
+        near_duplicates = 0
+        last_progress = time.monotonic()
+        
+        async def save_one(record):
+            nonlocal failed, near_duplicates, last_progress
+            try:
+                async with semaphore:
+                    saved_path = await self.save_record(context, shard, record)
+            except NearDuplicateError:
+                near_duplicates += 1
+                saved_path = False
+            
+            if saved_path:
+                saved.append(record)
+            elif saved_path is None:
+                failed += 1
+            
+            # Throttled progress updates
+            if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                try:
+                    await progress.edit_text(
+                        f"🔄 **Saving media...** {len(saved) + failed + near_duplicates}/{len(pending)}",
+                        parse_mode='Markdown'
+                    )
+                except Exception as e:
+                    logger.warning("Progress update failed: %s", e)
+        
+        await asyncio.gather(*(save_one(record) for record in pending))
+        
+        summary_text = (
+            f"✅ **Batch Save Complete!**\n\n"
+            f"📁 **Saved:** {len(saved)} files ({format_file_size(sum(record.file_size or 0 for record in saved))})\n"
+            f"⏭️ **Already saved:** {skipped}\n"
+            f"🖼️ **Near-duplicates skipped:** {near_duplicates}\n"
+            f"❌ **Failed:** {failed}\n"
+            f"💾 **Saved By:** {update.effective_user.first_name}"
+        )
+        if saved:
+            summary_text += f"\n\n📄 First: `{min(saved, key=lambda record: record.message_id).saved_filename}`"
+        
+        try:
+            await progress.edit_text(summary_text, parse_mode='Markdown')
+        except Exception:
+            await update.message.reply_text(summary_text, parse_mode='Markdown')
+        logger.info("Batch saved %s/%s media in chat %s", len(saved), len(pending), update.effective_chat.id)
+
+    def existing_file_ids(self, shard, file_ids):
+        """Subset of file_ids already saved in a shard"""
+        existing = set()
+        conn = sqlite3.connect(shard.db_path)
+        # Chunked to stay under SQLite's bound parameter limit
+        for start in range(0, len(file_ids), 500):
+            chunk = file_ids[start:start + 500]
+            cursor = conn.execute(
+                f"SELECT file_id FROM saved_media WHERE file_id IN ({', '.join('?' * len(chunk))})", chunk
+            )
+            existing.update(file_id for file_id, in cursor)
+        conn.close()
+        return existing
+
     async def get_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /get command to retrieve media by filename"""
         if not context.args:
@@ -328,6 +2009,19 @@ class ReplySaveBot:
         filename = ' '.join(context.args)
         await self.send_media_by_filename(update, context, filename)
 
+    async def preview_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /preview command: a compact copy of a saved photo or GIF"""
+        if not context.args:
+            await update.message.reply_text(
+                "🔎 **Usage:** `/preview <filename>`\n"
+                "Sends a small recompressed copy of photos and GIFs (other media are sent as is)",
+                parse_mode='Markdown'
+            )
+            return
+        
+        filename = ' '.join(context.args)
+        await self.send_media_by_filename(update, context, filename, preview=True)
+
     async def handle_media_request(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle non-command text messages as potential media filename requests"""
         message_text = update.message.text.strip()
@@ -343,150 +2037,253 @@ class ReplySaveBot:
             
             await self.send_media_by_filename(update, context, message_text)
 
-    async def send_media_by_filename(self, update: Update, context: ContextTypes.DEFAULT_TYPE, filename):
-        """Send media file by filename"""
+    async def send_media_by_filename(self, update: Update, context: ContextTypes.DEFAULT_TYPE, filename, preview=False):
+        """Send media file by filename (a compact preview copy of images in preview mode)"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # Search for exact filename or partial match
-            cursor.execute('''
-                SELECT saved_filename, file_path, media_type, file_size, caption, user_first_name, save_date
-                FROM saved_media 
-                WHERE saved_filename = ? OR saved_filename LIKE ?
-                ORDER BY save_date DESC
-                LIMIT 1
-            ''', (filename, f'%{filename}%'))
-            
-            result = cursor.fetchone()
-            conn.close()
+            # Identical lookups in flight share one database query
+            shards = self.router.shards_for(update.effective_chat.id)
+            record = await self.inflight.do(
+                ('lookup', tuple(shard.shard_id for shard in shards), filename),
+                asyncio.to_thread, self.lookup_media, shards, filename
+            )
             
-            if not result:
+            if not record:
                 # Try to find similar filenames for suggestions
-                await self.suggest_similar_files(update, filename)
+                await self.suggest_similar_files(update, shards, filename)
                 return
-                
-            saved_filename, file_path, media_type, file_size, caption, sender, save_date = result
             
             # Check if file exists
-            if not Path(file_path).exists():
+            if not Path(record.file_path).exists():
                 await update.message.reply_text(
-                    f"❌ **File not found on disk:** `{saved_filename}`\n"
+                    f"❌ **File not found on disk:** `{record.saved_filename}`\n"
                     f"The file may have been moved or deleted.",
                     parse_mode='Markdown'
                 )
                 return
             
-            # Send typing action
-            await context.bot.send_chat_action(
-                chat_id=update.effective_chat.id,
-                action='upload_document'
-            )
-            
-            # Prepare file info message
-            date_obj = datetime.fromisoformat(save_date.replace('Z', '+00:00'))
-            info_text = (
-                f"📁 **{saved_filename}**\n"
-                f"📂 Type: {media_type.title()}\n"
-                f"📊 Size: {self.format_file_size(file_size or 0)}\n"
-                f"👤 Original Sender: {sender or 'Unknown'}\n"
-                f"📅 Saved: {date_obj.strftime('%Y-%m-%d %H:%M:%S')}"
-            )
-            
-            if caption:
-                info_text += f"\n💬 Caption: {caption}"
+            # Preview mode sends the recompressed copy of photos and GIFs when there is one
+            if preview:
+                variant = await self.variant_record(record, 'preview') if 'preview' in IMAGE_VARIANTS else None
+                if variant:
+                    await self.deliver_media(
+                        context, update.effective_chat.id, variant,
+                        self.render_media_caption(record) + "\n🔎 Preview • send the filename for the original",
+                        action='upload_photo'
+                    )
+                    logger.info("Preview sent: %s to user %s", record.saved_filename, update.effective_user.id)
+                    return
             
             # Send the media file based on its type
-            with open(file_path, 'rb') as media_file:
-                if media_type == 'photo':
-                    await context.bot.send_photo(
-                        chat_id=update.effective_chat.id,
-                        photo=media_file,
-                        caption=info_text,
-                        parse_mode='Markdown'
-                    )
-                elif media_type == 'video':
-                    await context.bot.send_video(
-                        chat_id=update.effective_chat.id,
-                        video=media_file,
-                        caption=info_text,
-                        parse_mode='Markdown'
-                    )
-                elif media_type == 'audio':
-                    await context.bot.send_audio(
-                        chat_id=update.effective_chat.id,
-                        audio=media_file,
-                        caption=info_text,
-                        parse_mode='Markdown'
-                    )
-                elif media_type == 'voice':
-                    await context.bot.send_voice(
-                        chat_id=update.effective_chat.id,
-                        voice=media_file,
-                        caption=info_text,
-                        parse_mode='Markdown'
-                    )
-                elif media_type == 'video_note':
-                    await context.bot.send_video_note(
-                        chat_id=update.effective_chat.id,
-                        video_note=media_file
-                    )
-                    # Send info separately for video notes (they don't support captions)
-                    await update.message.reply_text(info_text, parse_mode='Markdown')
-                elif media_type == 'animation':
-                    await context.bot.send_animation(
-                        chat_id=update.effective_chat.id,
-                        animation=media_file,
-                        caption=info_text,
-                        parse_mode='Markdown'
-                    )
-                else:  # document
-                    await context.bot.send_document(
-                        chat_id=update.effective_chat.id,
-                        document=media_file,
-                        caption=info_text,
-                        parse_mode='Markdown'
-                    )
+            await self.deliver_media(context, update.effective_chat.id, record, self.render_media_caption(record))
             
-            logger.info(f"Media sent: {saved_filename} to user {update.effective_user.id}")
+            logger.info("Media sent: %s to user %s", record.saved_filename, update.effective_user.id)
             
         except Exception as e:
-            logger.error(f"Error sending media {filename}: {e}")
+            logger.error("Error sending media %s: %s", filename, e)
             await update.message.reply_text(
                 f"❌ **Error sending media:** `{filename}`\n"
                 f"Please try again or contact support.",
                 parse_mode='Markdown'
             )
 
-    async def suggest_similar_files(self, update: Update, filename):
+    def render_media_caption(self, record):
+        """File info caption sent with retrieved media, cached per media"""
+        key = (record.media_key, 'caption', SCHEMA_VERSION)
+        info_text = self.render_cache.get(key)
+        
+        if info_text is None:
+            info_text = (
+                f"📁 **{record.saved_filename}**\n"
+                f"📂 Type: {record.media_type.title()}\n"
+                f"📊 Size: {record.size_text}\n"
+                f"👤 Original Sender: {record.user_first_name or 'Unknown'}\n"
+                f"📅 Saved: {record.date_text}"
+            )
+            
+            if record.caption:
+                info_text += f"\n💬 Caption: {record.caption}"
+            self.render_cache.put(key, info_text)
+        
+        return info_text
+
+    def query_media(self, shards, sql, params=(), newest_first=True, limit=None):
+        """Run a SELECT on each shard, merging rows by save date across shards"""
+        if len(shards) == 1:
+            return shards[0].query(sql, params)
+        
+        records = [record for shard in shards for record in shard.query(sql, params)]
+        records.sort(key=lambda record: record.save_date, reverse=newest_first)
+        return records[:limit] if limit else records
+
+    def lookup_media(self, shards, filename):
+        """Find the most recent saved media matching a filename"""
+        # Exact filename first (index seek), then fall back to a partial match
+        for condition, pattern in (('m.saved_filename = ?', filename), ('m.saved_filename LIKE ?', f'%{filename}%')):
+            results = self.query_media(shards, f'''
+                SELECT m.saved_filename, m.file_path, m.media_type, m.file_size, m.caption,
+                       u.first_name AS user_first_name, m.save_date, m.size_text, m.date_text
+                FROM saved_media m
+                LEFT JOIN users u ON u.user_id = m.user_id
+                WHERE {condition}
+                ORDER BY m.save_date DESC
+                LIMIT 1
+            ''', (pattern,), limit=1)
+            if results:
+                return results[0]
+        return None
+
+    async def deliver_media(self, context, chat_id, record, info_text, action='upload_document'):
+        """Send saved media to a chat, sharing identical in-flight deliveries
+        
+        The flight is keyed by media and chat only, so concurrent requests for
+        the same media in the same chat (say /start and /get of one video)
+        send a single message carrying the caption of whichever came first.
+        """
+        started = time.perf_counter()
+        cached = record.media_key in self.sent_file_ids
+        file_id = await self.inflight.do(
+            ('deliver', record.media_key, chat_id),
+            self._deliver_media, context, chat_id, record, info_text, action
+        )
+        audit('retrieve', shard=record.shard_id, file=record.saved_filename, media_type=record.media_type,
+              bytes=record.file_size, chat_id=chat_id, cached_file_id=cached,
+              duration_ms=round((time.perf_counter() - started) * 1000, 1))
+        return file_id
+
+    async def _deliver_media(self, context, chat_id, record, info_text, action):
+        """Send by cached file_id, or upload once and let other chats reuse the result"""
+        file_id = self.sent_file_ids.get(record.media_key)
+        
+        if file_id is None:
+            # Only one upload per media at a time; concurrent chats wait for its file_id
+            flight = ('upload', record.media_key)
+            joined = flight in self.inflight.calls
+            try:
+                uploaded_chat_id, file_id = await self.inflight.do(
+                    flight, self.upload_media, context, chat_id, record, info_text, action
+                )
+            except Exception as e:
+                if not joined:
+                    raise
+                # Another chat's upload failed (blocked, not found...), which says nothing about this one
+                logger.warning("Shared upload of %s failed, retrying for chat %s: %s", record.saved_filename, chat_id, e)
+                return await self._deliver_media(context, chat_id, record, info_text, action)
+            if uploaded_chat_id == chat_id:
+                return file_id
+            if file_id is None:
+                # The shared upload returned nothing reusable, upload for this chat too
+                _, file_id = await self.upload_media(context, chat_id, record, info_text, action)
+                return file_id
+        
+        if action:
+            await context.bot.send_chat_action(chat_id=chat_id, action=action)
+        try:
+            await self.send_media_payload(context.bot, chat_id, record.media_type, file_id, info_text)
+        except BadRequest as e:
+            # Other chat errors (not found, no rights) say nothing about the file_id
+            if 'file' not in e.message.lower():
+                raise
+            # Stale file_id, fall back to a fresh upload
+            logger.warning("Cached file_id rejected for %s: %s", record.saved_filename, e)
+            self.sent_file_ids.pop(record.media_key, None)
+            _, file_id = await self.upload_media(context, chat_id, record, info_text, action)
+        return file_id
+
+    async def upload_media(self, context, chat_id, record, info_text, action):
+        """Upload media from disk and remember the file_id Telegram returns"""
+        if action:
+            await context.bot.send_chat_action(chat_id=chat_id, action=action)
+        
+        with open(record.file_path, 'rb') as media_file:
+            message = await self.send_media_payload(context.bot, chat_id, record.media_type, media_file, info_text)
+        
+        sent = self.extract_media_info(message)
+        file_id = sent.file_id if sent else None
+        if file_id:
+            self.sent_file_ids[record.media_key] = file_id
+        return chat_id, file_id
+
+    async def send_media_payload(self, bot, chat_id, media_type, media, info_text):
+        """Send a file object or file_id using the method matching its media type"""
+        if media_type == 'photo':
+            return await bot.send_photo(
+                chat_id=chat_id,
+                photo=media,
+                caption=info_text,
+                parse_mode='Markdown'
+            )
+        elif media_type == 'video':
+            return await bot.send_video(
+                chat_id=chat_id,
+                video=media,
+                caption=info_text,
+                parse_mode='Markdown'
+            )
+        elif media_type == 'audio':
+            return await bot.send_audio(
+                chat_id=chat_id,
+                audio=media,
+                caption=info_text,
+                parse_mode='Markdown'
+            )
+        elif media_type == 'voice':
+            return await bot.send_voice(
+                chat_id=chat_id,
+                voice=media,
+                caption=info_text,
+                parse_mode='Markdown'
+            )
+        elif media_type == 'video_note':
+            message = await bot.send_video_note(
+                chat_id=chat_id,
+                video_note=media
+            )
+            # Send info separately for video notes (they don't support captions)
+            await bot.send_message(chat_id=chat_id, text=info_text, parse_mode='Markdown')
+            return message
+        elif media_type == 'animation':
+            return await bot.send_animation(
+                chat_id=chat_id,
+                animation=media,
+                caption=info_text,
+                parse_mode='Markdown'
+            )
+        else:  # document
+            return await bot.send_document(
+                chat_id=chat_id,
+                document=media,
+                caption=info_text,
+                parse_mode='Markdown'
+            )
+
+    async def suggest_similar_files(self, update: Update, shards, filename):
         """Suggest similar filenames when exact match not found"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # Search for similar filenames
-            cursor.execute('''
-                SELECT saved_filename, media_type, save_date
-                FROM saved_media 
-                WHERE saved_filename LIKE ?
-                ORDER BY save_date DESC
-                LIMIT 5
-            ''', (f'%{filename}%',))
-            
-            results = cursor.fetchall()
-            conn.close()
+            key = (None, 'suggest', tuple(shard.shard_id for shard in shards), filename, SCHEMA_VERSION)
+            suggestion_text = self.render_cache.get(key)
             
-            if results:
-                suggestion_text = f"❌ **File not found:** `{filename}`\n\n"
-                suggestion_text += "🔍 **Did you mean:**\n\n"
-                
-                for saved_filename, media_type, save_date in results:
-                    date_obj = datetime.fromisoformat(save_date.replace('Z', '+00:00'))
-                    suggestion_text += f"📄 `{saved_filename}`\n"
-                    suggestion_text += f"   📂 {media_type.title()} • 📅 {date_obj.strftime('%m/%d %H:%M')}\n\n"
-                
-                suggestion_text += "💡 **Tip:** Send the exact filename to get the media"
+            if suggestion_text is None:
+                # Search for similar filenames
+                results = self.query_media(shards, '''
+                    SELECT saved_filename, media_type, save_date, date_text
+                    FROM saved_media 
+                    WHERE saved_filename LIKE ?
+                    ORDER BY save_date DESC
+                    LIMIT 5
+                ''', (f'%{filename}%',), limit=5)
                 
+                if results:
+                    suggestion_text = f"❌ **File not found:** `{filename}`\n\n"
+                    suggestion_text += "🔍 **Did you mean:**\n\n"
+                    
+                    for record in results:
+                        suggestion_text += f"📄 `{record.saved_filename}`\n"
+                        suggestion_text += f"   📂 {record.media_type.title()} • 📅 {record.short_date}\n\n"
+                    
+                    suggestion_text += "💡 **Tip:** Send the exact filename to get the media"
+                    self.render_cache.put(key, suggestion_text)
+            
+            if suggestion_text:
                 await update.message.reply_text(suggestion_text, parse_mode='Markdown')
             else:
                 await update.message.reply_text(
@@ -496,116 +2293,63 @@ class ReplySaveBot:
                 )
                 
         except Exception as e:
-            logger.error(f"Error suggesting files: {e}")
+            logger.error("Error suggesting files: %s", e)
             await update.message.reply_text(
                 f"❌ **File not found:** `{filename}`",
                 parse_mode='Markdown'
             )
 
     def extract_media_info(self, message):
-        """Extract media information from message"""
-        media_info = {
-            'user_id': message.from_user.id if message.from_user else None,
-            'username': message.from_user.username if message.from_user else None,
-            'user_first_name': message.from_user.first_name if message.from_user else None,
-            'chat_id': message.chat.id,
-            'message_id': message.message_id,
-            'caption': message.caption,
-            'date': message.date
-        }
-        
-        # Check for different media types
+        """Extract media information from message into a MediaRecord"""
+        # Pick the media object first; only plain fields are copied out of it
         if message.video:
-            media_info.update({
-                'media_type': 'video',
-                'media_object': message.video,
-                'file_id': message.video.file_id,
-                'file_size': message.video.file_size,
-                'duration': message.video.duration,
-                'width': message.video.width,
-                'height': message.video.height,
-                'mime_type': message.video.mime_type
-            })
-            
+            media_type, media = 'video', message.video
         elif message.photo:
-            photo = message.photo[-1]  # Get highest resolution
-            media_info.update({
-                'media_type': 'photo',
-                'media_object': photo,
-                'file_id': photo.file_id,
-                'file_size': photo.file_size,
-                'width': photo.width,
-                'height': photo.height
-            })
-            
+            media_type, media = 'photo', message.photo[-1]  # Get highest resolution
         elif message.audio:
-            media_info.update({
-                'media_type': 'audio',
-                'media_object': message.audio,
-                'file_id': message.audio.file_id,
-                'original_filename': message.audio.file_name,
-                'file_size': message.audio.file_size,
-                'duration': message.audio.duration,
-                'mime_type': message.audio.mime_type
-            })
-            
+            media_type, media = 'audio', message.audio
         elif message.voice:
-            media_info.update({
-                'media_type': 'voice',
-                'media_object': message.voice,
-                'file_id': message.voice.file_id,
-                'file_size': message.voice.file_size,
-                'duration': message.voice.duration,
-                'mime_type': message.voice.mime_type
-            })
-            
+            media_type, media = 'voice', message.voice
         elif message.video_note:
-            media_info.update({
-                'media_type': 'video_note',
-                'media_object': message.video_note,
-                'file_id': message.video_note.file_id,
-                'file_size': message.video_note.file_size,
-                'duration': message.video_note.duration
-            })
-            
+            media_type, media = 'video_note', message.video_note
         elif message.document:
-            media_info.update({
-                'media_type': 'document',
-                'media_object': message.document,
-                'file_id': message.document.file_id,
-                'original_filename': message.document.file_name,
-                'file_size': message.document.file_size,
-                'mime_type': message.document.mime_type
-            })
-            
+            media_type, media = 'document', message.document
         elif message.animation:
-            media_info.update({
-                'media_type': 'animation',
-                'media_object': message.animation,
-                'file_id': message.animation.file_id,
-                'file_size': message.animation.file_size,
-                'width': message.animation.width,
-                'height': message.animation.height,
-                'duration': message.animation.duration,
-                'mime_type': message.animation.mime_type
-            })
+            media_type, media = 'animation', message.animation
         else:
             return None
-            
-        return media_info
+        
+        sender = message.from_user
+        return MediaRecord(
+            media_type=media_type,
+            file_id=media.file_id,
+            file_size=media.file_size,
+            # Only audio and documents keep their original filename
+            original_filename=media.file_name if media_type in ('audio', 'document') else None,
+            mime_type=getattr(media, 'mime_type', None),
+            duration=getattr(media, 'duration', None),
+            width=getattr(media, 'width', None),
+            height=getattr(media, 'height', None),
+            caption=message.caption,
+            chat_id=message.chat.id,
+            message_id=message.message_id,
+            user_id=sender.id if sender else None,
+            username=sender.username if sender else None,
+            user_first_name=sender.first_name if sender else None
+        )
 
-    async def save_media(self, context, message, media_info):
+    async def save_media(self, context, shard, record):
         """Save media file to storage"""
         try:
             # Get file from Telegram
-            file = await context.bot.get_file(media_info['file_id'])
+            file = await context.bot.get_file(record.file_id)
             
             # Generate filename
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             
-            if media_info.get('original_filename'):
+            if record.original_filename:
                 # Use original filename
-                original_name = Path(media_info['original_filename'])
+                original_name = Path(record.original_filename)
                 filename = f"{timestamp}_{original_name.stem}{original_name.suffix}"
             else:
                 # Generate filename based on media type
@@ -618,88 +2362,81 @@ class ReplySaveBot:
                     'document': '',
                     'animation': '.gif'
                 }
-                ext = extensions.get(media_info['media_type'], '')
-                filename = f"{timestamp}_{media_info['file_id'][:8]}{ext}"
+                ext = extensions.get(record.media_type, '')
+                filename = f"{timestamp}_{record.file_id[:8]}{ext}"
             
-            # Create file path
-            media_type = media_info['media_type']
-            file_path = self.media_dirs[media_type] / filename
+            # Create file path, never reusing a name another save in flight took
+            file_path = shard.media_dirs[record.media_type] / filename
+            counter = 1
+            while file_path in self.reserved_paths or file_path.exists():
+                file_path = file_path.with_name(f"{Path(filename).stem}_{counter}{Path(filename).suffix}")
+                counter += 1
+            filename = file_path.name
             
             # Download file
-            await file.download_to_drive(file_path)
+            self.reserved_paths.add(file_path)
+            try:
+                await file.download_to_drive(file_path)
+            finally:
+                self.reserved_paths.discard(file_path)
             
-            # Update media info
-            media_info['saved_filename'] = filename
-            media_info['file_path'] = str(file_path)
+            # Update media record
+            record.saved_filename = filename
+            record.file_path = str(file_path)
+            record.shard_id = shard.shard_id
             
-            logger.info(f"Media saved: {filename}")
+            logger.info("Media saved: %s", filename)
             return file_path
             
         except Exception as e:
-            logger.error(f"Error saving media: {e}")
+            logger.error("Error saving media: %s", e)
             return None
 
-    def save_to_database(self, media_info):
-        """Save media information to database"""
+    def save_to_database(self, shard, record):
+        """Queue a media record for the database, returning a commit future"""
+        # Display fields are formatted once here instead of on every render
+        record.save_date = int(time.time())
+        record.size_text = format_file_size(record.file_size or 0)
+        record.date_text = format_save_date(record.save_date)
+        return shard.writer.submit_all(media_record_statements(record))
+
+    async def wait_for_write(self, ack):
+        """Wait for a queued write to be committed, returning False on failure"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                INSERT OR REPLACE INTO saved_media (
-                    file_id, media_type, original_filename, saved_filename, file_path,
-                    file_size, user_id, username, user_first_name, chat_id, message_id,
-                    caption, saved_by_user_id, saved_by_username, mime_type,
-                    duration, width, height
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                media_info['file_id'],
-                media_info['media_type'],
-                media_info.get('original_filename'),
-                media_info['saved_filename'],
-                media_info['file_path'],
-                media_info.get('file_size'),
-                media_info.get('user_id'),
-                media_info.get('username'),
-                media_info.get('user_first_name'),
-                media_info['chat_id'],
-                media_info['message_id'],
-                media_info.get('caption'),
-                media_info['saved_by_user_id'],
-                media_info.get('saved_by_username'),
-                media_info.get('mime_type'),
-                media_info.get('duration'),
-                media_info.get('width'),
-                media_info.get('height')
-            ))
-            
-            conn.commit()
-            conn.close()
-            
+            await asyncio.wrap_future(ack)
+            return True
         except Exception as e:
-            logger.error(f"Database error: {e}")
+            logger.error("Database error: %s", e)
+            return False
 
     async def stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show statistics of saved media"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # Get counts by media type
-            cursor.execute('''
-                SELECT media_type, COUNT(*), SUM(file_size) 
-                FROM saved_media 
-                GROUP BY media_type 
-                ORDER BY COUNT(*) DESC
-            ''')
+            totals = {}
+            for shard in self.router.shards_for(update.effective_chat.id):
+                conn = sqlite3.connect(shard.db_path)
+                cursor = conn.cursor()
+                
+                # Get counts by media type
+                cursor.execute('''
+                    SELECT media_type, COUNT(*), SUM(file_size) 
+                    FROM saved_media 
+                    GROUP BY media_type
+                ''')
+                
+                for media_type, count, size in cursor.fetchall():
+                    total = totals.setdefault(media_type, [0, 0])
+                    total[0] += count
+                    total[1] += size or 0
+                
+                conn.close()
             
-            results = cursor.fetchall()
+            results = sorted(((media_type, count, size) for media_type, (count, size) in totals.items()),
+                             key=lambda result: result[1], reverse=True)
             
             # Get total count
-            cursor.execute('SELECT COUNT(*), SUM(file_size) FROM saved_media')
-            total_count, total_size = cursor.fetchone()
-            
-            conn.close()
+            total_count = sum(count for _, count, _ in results)
+            total_size = sum(size for _, _, size in results)
             
             if not results:
                 await update.message.reply_text("📊 No saved media found!")
@@ -708,55 +2445,92 @@ class ReplySaveBot:
             stats_text = "📊 **Saved Media Statistics**\n\n"
             
             for media_type, count, size in results:
-                size_str = self.format_file_size(size or 0)
+                size_str = format_file_size(size or 0)
                 stats_text += f"📁 **{media_type.title()}:** {count} files ({size_str})\n"
             
-            stats_text += f"\n📈 **Total:** {total_count} files ({self.format_file_size(total_size or 0)})"
+            stats_text += f"\n📈 **Total:** {total_count} files ({format_file_size(total_size or 0)})"
+            if self.metrics['retention_expired']:
+                stats_text += f"\n🧹 **Expired by retention:** {self.metrics['retention_expired']} files"
             
             await update.message.reply_text(stats_text, parse_mode='Markdown')
             
         except Exception as e:
-            logger.error(f"Stats error: {e}")
+            logger.error("Stats error: %s", e)
             await update.message.reply_text("❌ Error retrieving statistics")
 
     async def list_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """List recent saved media"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                SELECT saved_filename, media_type, user_first_name, save_date 
-                FROM saved_media 
-                ORDER BY save_date DESC 
-                LIMIT 10
-            ''')
-            
-            results = cursor.fetchall()
-            conn.close()
+            shards = self.router.shards_for(update.effective_chat.id)
+            key = (None, 'list', tuple(shard.shard_id for shard in shards), SCHEMA_VERSION)
+            list_text = self.render_cache.get(key)
             
-            if not results:
-                await update.message.reply_text("📂 No saved media found!")
-                return
+            if list_text is None:
+                results = self.query_media(shards, '''
+                    SELECT m.saved_filename, m.media_type, u.first_name AS user_first_name, m.save_date, m.date_text
+                    FROM saved_media m
+                    LEFT JOIN users u ON u.user_id = m.user_id
+                    ORDER BY m.save_date DESC
+                    LIMIT 10
+                ''', limit=10)
                 
-            list_text = "📂 **Recent Saved Media (Last 10)**\n\n"
-            
-            for filename, media_type, sender, save_date in results:
-                # Format date
-                date_obj = datetime.fromisoformat(save_date.replace('Z', '+00:00'))
-                formatted_date = date_obj.strftime("%m/%d %H:%M")
+                if not results:
+                    await update.message.reply_text("📂 No saved media found!")
+                    return
+                    
+                list_text = "📂 **Recent Saved Media (Last 10)**\n\n"
                 
-                list_text += f"📄 `{filename}`\n"
-                list_text += f"   📂 {media_type.title()} • 👤 {sender or 'Unknown'} • 📅 {formatted_date}\n\n"
-            
-            list_text += "💡 **Tip:** Send any filename to get the media file"
+                for record in results:
+                    list_text += f"📄 `{record.saved_filename}`\n"
+                    list_text += f"   📂 {record.media_type.title()} • 👤 {record.user_first_name or 'Unknown'} • 📅 {record.short_date}\n\n"
+                
+                list_text += "💡 **Tip:** Send any filename to get the media file"
+                self.render_cache.put(key, list_text)
             
             await update.message.reply_text(list_text, parse_mode='Markdown')
             
+            if context.args and context.args[0].lower() == 'grid':
+                await self.send_thumbnail_grid(update, context, shards)
+            
         except Exception as e:
-            logger.error(f"List error: {e}")
+            logger.error("List error: %s", e)
             await update.message.reply_text("❌ Error retrieving media list")
 
+    async def send_thumbnail_grid(self, update: Update, context: ContextTypes.DEFAULT_TYPE, shards):
+        """Send thumbnails of the latest images as one album, reusing uploaded thumbnail file_ids"""
+        records = self.query_media(shards, '''
+            SELECT m.saved_filename, m.media_type, m.save_date, v.file_path, v.file_size
+            FROM saved_media m
+            JOIN media_variants v ON v.media_id = m.id AND v.variant = 'thumb'
+            ORDER BY m.save_date DESC
+            LIMIT 10
+        ''', limit=10)
+        # Thumbnails missing on disk (e.g. after restoring an export) come back with /preview
+        records = [record for record in records if Path(record.file_path).exists()]
+        
+        if not records:
+            await update.message.reply_text("🖼️ No image thumbnails yet!")
+            return
+        
+        media = []
+        for record in records:
+            file_id = self.sent_file_ids.get((record.shard_id, f"{record.saved_filename}@thumb"))
+            media.append(InputMediaPhoto(
+                media=file_id or await asyncio.to_thread(Path(record.file_path).read_bytes),
+                caption=record.saved_filename
+            ))
+        
+        if len(media) == 1:
+            # Albums need at least two items
+            messages = [await context.bot.send_photo(
+                chat_id=update.effective_chat.id, photo=media[0].media, caption=media[0].caption
+            )]
+        else:
+            messages = await context.bot.send_media_group(chat_id=update.effective_chat.id, media=media)
+        for record, message in zip(records, messages):
+            if message.photo:
+                self.sent_file_ids[(record.shard_id, f"{record.saved_filename}@thumb")] = message.photo[-1].file_id
+
     async def search_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Search saved media"""
         if not context.args:
@@ -770,45 +2544,120 @@ class ReplySaveBot:
         query = ' '.join(context.args)
         
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                SELECT saved_filename, media_type, user_first_name, caption, save_date 
-                FROM saved_media 
-                WHERE saved_filename LIKE ? OR caption LIKE ? OR user_first_name LIKE ?
-                ORDER BY save_date DESC
-                LIMIT 15
-            ''', (f'%{query}%', f'%{query}%', f'%{query}%'))
-            
-            results = cursor.fetchall()
-            conn.close()
+            shards = self.router.shards_for(update.effective_chat.id)
+            key = (None, 'search', tuple(shard.shard_id for shard in shards), query, SCHEMA_VERSION)
+            search_text = self.render_cache.get(key)
             
-            if not results:
-                await update.message.reply_text(f"🔍 No results found for: `{query}`", parse_mode='Markdown')
-                return
+            if search_text is None:
+                results = self.query_media(shards, '''
+                    SELECT m.saved_filename, m.media_type, u.first_name AS user_first_name, m.caption,
+                           m.save_date, m.date_text
+                    FROM saved_media m
+                    LEFT JOIN users u ON u.user_id = m.user_id
+                    WHERE m.saved_filename LIKE ? OR m.caption LIKE ? OR u.first_name LIKE ?
+                    ORDER BY m.save_date DESC
+                    LIMIT 15
+                ''', (f'%{query}%', f'%{query}%', f'%{query}%'), limit=15)
                 
-            search_text = f"🔍 **Search Results for:** `{query}`\n\n"
-            
-            for filename, media_type, sender, caption, save_date in results:
-                date_obj = datetime.fromisoformat(save_date.replace('Z', '+00:00'))
-                formatted_date = date_obj.strftime("%m/%d %H:%M")
+                if not results:
+                    await update.message.reply_text(f"🔍 No results found for: `{query}`", parse_mode='Markdown')
+                    return
+                    
+                search_text = f"🔍 **Search Results for:** `{query}`\n\n"
                 
-                search_text += f"📄 `{filename}`\n"
-                search_text += f"   📂 {media_type.title()} • 👤 {sender or 'Unknown'} • 📅 {formatted_date}\n"
+                for record in results:
+                    search_text += f"📄 `{record.saved_filename}`\n"
+                    search_text += f"   📂 {record.media_type.title()} • 👤 {record.user_first_name or 'Unknown'} • 📅 {record.short_date}\n"
+                    
+                    if record.caption:
+                        search_text += f"   💬 {record.caption[:50]}{'...' if len(record.caption) > 50 else ''}\n"
+                    search_text += "\n"
                 
-                if caption:
-                    search_text += f"   💬 {caption[:50]}{'...' if len(caption) > 50 else ''}\n"
-                search_text += "\n"
-            
-            search_text += "💡 **Tip:** Send any filename to get the media file"
+                search_text += "💡 **Tip:** Send any filename to get the media file"
+                self.render_cache.put(key, search_text)
             
             await update.message.reply_text(search_text, parse_mode='Markdown')
             
         except Exception as e:
-            logger.error(f"Search error: {e}")
+            logger.error("Search error: %s", e)
             await update.message.reply_text("❌ Error performing search")
 
+    async def similar_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Find saved photos that look like a given saved photo"""
+        if not context.args:
+            await update.message.reply_text(
+                "🖼️ **Usage:** `/similar <filename>`\n"
+                "Finds resized or recompressed copies of a saved photo",
+                parse_mode='Markdown'
+            )
+            return
+        
+        if np is None or Image is None:
+            await update.message.reply_text("❌ Similar photo search needs numpy and Pillow installed on the bot")
+            return
+        
+        filename = ' '.join(context.args)
+        
+        try:
+            shards = self.router.shards_for(update.effective_chat.id)
+            record = await asyncio.to_thread(self.lookup_photo_hash, shards, filename)
+            
+            if not record:
+                await update.message.reply_text(f"❌ **Photo not found:** `{filename}`", parse_mode='Markdown')
+                return
+            
+            if record.dhash is None:
+                # Saved before hashing was available, hash it now and keep the result
+                record.dhash = await self.compute_photo_hash(record.file_path)
+                if record.dhash is None:
+                    await update.message.reply_text(f"❌ Could not read `{record.saved_filename}`", parse_mode='Markdown')
+                    return
+                self.router.shards[record.shard_id].writer.submit(
+                    'INSERT OR REPLACE INTO photo_hashes (media_id, dhash, b0, b1, b2, b3) VALUES (?, ?, ?, ?, ?, ?)',
+                    (record.id, to_signed64(record.dhash), *dhash_bands(record.dhash))
+                )
+            
+            matches = []
+            for shard in shards:
+                for distance, match in await asyncio.to_thread(shard.similar_photos, record.dhash):
+                    if match.media_key != record.media_key:
+                        matches.append((distance, match))
+            matches.sort(key=lambda match: match[0])
+            
+            if not matches:
+                await update.message.reply_text(
+                    f"🖼️ No photos similar to `{record.saved_filename}`",
+                    parse_mode='Markdown'
+                )
+                return
+            
+            similar_text = f"🖼️ **Photos similar to** `{record.saved_filename}`\n\n"
+            for distance, match in matches[:10]:
+                similar_text += f"📄 `{match.saved_filename}`\n"
+                similar_text += f"   🎯 Distance: {distance} • 📊 {match.size_text} • 📅 {match.short_date}\n\n"
+            similar_text += "💡 **Tip:** Send any filename to get the media file"
+            
+            await update.message.reply_text(similar_text, parse_mode='Markdown')
+            
+        except Exception as e:
+            logger.error("Similar error: %s", e)
+            await update.message.reply_text("❌ Error searching similar photos")
+
+    def lookup_photo_hash(self, shards, filename):
+        """Most recent saved photo matching a filename, with its stored hash if any"""
+        for condition, pattern in (('m.saved_filename = ?', filename), ('m.saved_filename LIKE ?', f'%{filename}%')):
+            results = self.query_media(shards, f'''
+                SELECT m.id, m.saved_filename, m.file_path, m.media_type, m.save_date, h.dhash
+                FROM saved_media m
+                LEFT JOIN photo_hashes h ON h.media_id = m.id
+                WHERE {condition} AND m.media_type = 'photo'
+                ORDER BY m.save_date DESC
+                LIMIT 1
+            ''', (pattern,), limit=1)
+            if results:
+                return results[0]
+        return None
+
     async def delete_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Delete specific saved media"""
         if not context.args:
@@ -823,22 +2672,10 @@ class ReplySaveBot:
         filename = ' '.join(context.args)
         
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
             # Search for the file
-            cursor.execute('''
-                SELECT saved_filename, file_path, media_type, file_size, user_first_name, save_date
-                FROM saved_media 
-                WHERE saved_filename = ? OR saved_filename LIKE ?
-                ORDER BY save_date DESC
-                LIMIT 1
-            ''', (filename, f'%{filename}%'))
-            
-            result = cursor.fetchone()
+            record = self.lookup_media(self.router.shards_for(update.effective_chat.id), filename)
             
-            if not result:
-                conn.close()
+            if not record:
                 await update.message.reply_text(
                     f"❌ **File not found:** `{filename}`\n\n"
                     f"💡 Use `/list` to see available files or `/search <query>` to find media",
@@ -846,42 +2683,44 @@ class ReplySaveBot:
                 )
                 return
             
-            saved_filename, file_path, media_type, file_size, sender, save_date = result
-            
             # Delete from database
-            cursor.execute('DELETE FROM saved_media WHERE saved_filename = ?', (saved_filename,))
-            conn.commit()
-            conn.close()
+            started = time.perf_counter()
+            shard = self.router.shards[record.shard_id]
+            await asyncio.wrap_future(
+                shard.writer.submit('DELETE FROM saved_media WHERE saved_filename = ?', (record.saved_filename,))
+            )
+            self.forget_media(record)
             
             # Delete physical file
             file_deleted = False
-            if Path(file_path).exists():
+            if Path(record.file_path).exists():
                 try:
-                    Path(file_path).unlink()
+                    Path(record.file_path).unlink()
                     file_deleted = True
                 except Exception as e:
-                    logger.error(f"Error deleting physical file {file_path}: {e}")
-            
-            # Format date
-            date_obj = datetime.fromisoformat(save_date.replace('Z', '+00:00'))
+                    logger.error("Error deleting physical file %s: %s", record.file_path, e)
+            await asyncio.to_thread(self.remove_files, shard.variant_paths(record.saved_filename))
             
             # Send confirmation
             confirmation_text = (
                 f"✅ **Media Deleted Successfully!**\n\n"
-                f"📁 **File:** `{saved_filename}`\n"
-                f"📂 **Type:** {media_type.title()}\n"
-                f"📊 **Size:** {self.format_file_size(file_size or 0)}\n"
-                f"👤 **Original Sender:** {sender or 'Unknown'}\n"
-                f"📅 **Was Saved:** {date_obj.strftime('%Y-%m-%d %H:%M:%S')}\n"
+                f"📁 **File:** `{record.saved_filename}`\n"
+                f"📂 **Type:** {record.media_type.title()}\n"
+                f"📊 **Size:** {record.size_text}\n"
+                f"👤 **Original Sender:** {record.user_first_name or 'Unknown'}\n"
+                f"📅 **Was Saved:** {record.date_text}\n"
                 f"🗑️ **Deleted By:** {update.effective_user.first_name}\n"
                 f"💾 **File Status:** {'✅ Removed from disk' if file_deleted else '⚠️ Database entry removed (file not found on disk)'}"
             )
             
+            audit('delete', shard=shard.shard_id, file=record.saved_filename, media_type=record.media_type,
+                  bytes=record.file_size, user_id=update.effective_user.id, file_removed=file_deleted,
+                  duration_ms=round((time.perf_counter() - started) * 1000, 1))
             await update.message.reply_text(confirmation_text, parse_mode='Markdown')
-            logger.info(f"Media deleted: {saved_filename} by user {update.effective_user.id}")
+            logger.info("Media deleted: %s by user %s", record.saved_filename, update.effective_user.id)
             
         except Exception as e:
-            logger.error(f"Delete error: {e}")
+            logger.error("Delete error: %s", e)
             await update.message.reply_text(
                 f"❌ **Error deleting media:** `{filename}`\n"
                 f"Please try again or contact support.",
@@ -891,14 +2730,20 @@ class ReplySaveBot:
     async def delete_all_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Delete all saved media with confirmation"""
         try:
+            shards = self.router.shards_for(update.effective_chat.id)
+            
             # Check if confirmation argument is provided
             if not context.args or context.args[0].lower() != 'confirm':
                 # Get total count for warning
-                conn = sqlite3.connect(self.db_path)
-                cursor = conn.cursor()
-                cursor.execute('SELECT COUNT(*), SUM(file_size) FROM saved_media')
-                total_count, total_size = cursor.fetchone()
-                conn.close()
+                total_count = total_size = 0
+                for shard in shards:
+                    conn = sqlite3.connect(shard.db_path)
+                    cursor = conn.cursor()
+                    cursor.execute('SELECT COUNT(*), SUM(file_size) FROM saved_media')
+                    count, size = cursor.fetchone()
+                    conn.close()
+                    total_count += count
+                    total_size += size or 0
                 
                 if total_count == 0:
                     await update.message.reply_text(
@@ -911,7 +2756,7 @@ class ReplySaveBot:
                     f"⚠️ **WARNING: DELETE ALL MEDIA**\n\n"
                     f"📊 **This will permanently delete:**\n"
                     f"📁 **{total_count} media files**\n"
-                    f"💾 **{self.format_file_size(total_size or 0)} of storage**\n\n"
+                    f"💾 **{format_file_size(total_size or 0)} of storage**\n\n"
                     f"🚨 **This action cannot be undone!**\n\n"
                     f"💡 **To confirm deletion, use:**\n"
                     f"`/deleteall confirm`"
@@ -920,16 +2765,10 @@ class ReplySaveBot:
                 await update.message.reply_text(warning_text, parse_mode='Markdown')
                 return
             
-            # Perform deletion with confirmation
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
             # Get all files for deletion
-            cursor.execute('SELECT saved_filename, file_path FROM saved_media')
-            all_files = cursor.fetchall()
+            all_files = self.query_media(shards, 'SELECT saved_filename, file_path, file_size, save_date FROM saved_media')
             
             if not all_files:
-                conn.close()
                 await update.message.reply_text(
                     "📂 **No saved media found to delete.**",
                     parse_mode='Markdown'
@@ -937,13 +2776,15 @@ class ReplySaveBot:
                 return
             
             # Get stats before deletion
-            cursor.execute('SELECT COUNT(*), SUM(file_size) FROM saved_media')
-            total_count, total_size = cursor.fetchone()
+            total_count = len(all_files)
+            total_size = sum(record.file_size or 0 for record in all_files)
             
             # Delete all from database
-            cursor.execute('DELETE FROM saved_media')
-            conn.commit()
-            conn.close()
+            started = time.perf_counter()
+            for shard in shards:
+                await asyncio.wrap_future(shard.writer.submit('DELETE FROM saved_media'))
+            self.sent_file_ids.clear()
+            self.render_cache.clear()
             
             # Delete physical files
             files_deleted = 0
@@ -954,23 +2795,28 @@ class ReplySaveBot:
                 parse_mode='Markdown'
             )
             
-            for saved_filename, file_path in all_files:
+            for record in all_files:
                 try:
-                    if Path(file_path).exists():
-                        Path(file_path).unlink()
+                    if Path(record.file_path).exists():
+                        Path(record.file_path).unlink()
                         files_deleted += 1
                     else:
                         files_not_found += 1
                 except Exception as e:
-                    logger.error(f"Error deleting file {file_path}: {e}")
+                    logger.error("Error deleting file %s: %s", record.file_path, e)
                     files_not_found += 1
+            for shard in shards:
+                await asyncio.to_thread(shutil.rmtree, shard.base_dir / "variants", ignore_errors=True)
+            audit('delete_all', shards=[shard.shard_id for shard in shards], files=total_count, bytes=total_size,
+                  files_removed=files_deleted, user_id=update.effective_user.id,
+                  duration_ms=round((time.perf_counter() - started) * 1000, 1))
             
             # Send final confirmation
             confirmation_text = (
                 f"✅ **ALL MEDIA DELETED SUCCESSFULLY!**\n\n"
                 f"📊 **Deletion Summary:**\n"
                 f"🗑️ **Database entries removed:** {total_count}\n"
-                f"💾 **Storage freed:** {self.format_file_size(total_size or 0)}\n"
+                f"💾 **Storage freed:** {format_file_size(total_size or 0)}\n"
                 f"📁 **Files deleted from disk:** {files_deleted}\n"
                 f"⚠️ **Files not found on disk:** {files_not_found}\n\n"
                 f"👤 **Deleted by:** {update.effective_user.first_name}\n"
@@ -979,44 +2825,1488 @@ class ReplySaveBot:
             )
             
             await update.message.reply_text(confirmation_text, parse_mode='Markdown')
-            logger.info(f"All media deleted by user {update.effective_user.id}: {total_count} files")
+            logger.info("All media deleted by user %s: %s files", update.effective_user.id, total_count)
             
         except Exception as e:
-            logger.error(f"Delete all error: {e}")
+            logger.error("Delete all error: %s", e)
             await update.message.reply_text(
                 "❌ **Error deleting all media.** Please try again or contact support.",
                 parse_mode='Markdown'
             )
 
-    def format_file_size(self, size_bytes):
-        """Format file size in human readable format"""
-        if not size_bytes:
-            return "0 B"
+    async def retention_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """JobQueue callback running every retention rule over the owned shards"""
+        try:
+            if RETENTION_DRY_RUN:
+                for rule, count, size in await asyncio.to_thread(self.retention_report, list(self.router.shards.values())):
+                    logger.info("Retention dry run: %s files (%s) due for %s", count, format_file_size(size), rule.describe())
+                return
+            expired = await self.expire_media()
+            if expired:
+                logger.info("Retention expired %s files", expired)
+        except Exception as e:
+            logger.error("Retention error: %s", e)
+
+    def retention_report(self, shards):
+        """Files and bytes each rule would expire now, as (rule, count, size)"""
+        now = time.time()
+        report = []
+        for rule in self.retention_rules:
+            where, params = rule.where(now)
+            count = size = 0
+            for shard in shards:
+                conn = sqlite3.connect(shard.db_path)
+                try:
+                    shard_count, shard_size = conn.execute(
+                        f'SELECT COUNT(*), COALESCE(SUM(file_size), 0) FROM saved_media WHERE {where}', params
+                    ).fetchone()
+                finally:
+                    conn.close()
+                count += shard_count
+                size += shard_size
+            report.append((rule, count, size))
+        return report
+
+    async def expire_media(self):
+        """Delete expired media in small, spaced batches; returns how many went"""
+        expired = 0
+        for shard in list(self.router.shards.values()):
+            for rule in self.retention_rules:
+                while True:
+                    where, params = rule.where(time.time())
+                    records = await asyncio.to_thread(
+                        shard.query,
+                        f'''SELECT id, saved_filename, file_path, file_size FROM saved_media
+                            WHERE {where} ORDER BY save_date LIMIT ?''',
+                        params + [RETENTION_BATCH_SIZE]
+                    )
+                    if not records:
+                        break
+                    
+                    started = time.perf_counter()
+                    await asyncio.wrap_future(shard.writer.submit(
+                        f"DELETE FROM saved_media WHERE id IN ({', '.join('?' * len(records))})",
+                        [record.id for record in records]
+                    ))
+                    for record in records:
+                        self.forget_media(record)
+                    await asyncio.to_thread(self.remove_files, [
+                        path for record in records
+                        for path in [record.file_path, *shard.variant_paths(record.saved_filename)]
+                    ])
+                    
+                    batch_bytes = sum(record.file_size or 0 for record in records)
+                    audit('expire', shard=shard.shard_id, rule=rule.describe(), files=len(records), bytes=batch_bytes,
+                          duration_ms=round((time.perf_counter() - started) * 1000, 1))
+                    expired += len(records)
+                    self.metrics['retention_expired'] += len(records)
+                    self.metrics['retention_bytes'] += batch_bytes
+                    if len(records) < RETENTION_BATCH_SIZE:
+                        break
+                    await asyncio.sleep(RETENTION_BATCH_DELAY)
+        self.metrics['retention_runs'] += 1
+        return expired
+
+    def remove_files(self, file_paths):
+        """Unlink media files, logging the ones that cannot be removed"""
+        for file_path in file_paths:
+            try:
+                Path(file_path).unlink(missing_ok=True)
+            except Exception as e:
+                logger.error("Error deleting physical file %s: %s", file_path, e)
+
+    async def retention_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Dry-run report of the retention rules for the shards visible here"""
+        if not self.retention_rules:
+            await update.message.reply_text(
+                "🧹 **No retention rules configured.**\n\n"
+                "💡 Add rules to `RETENTION_RULES` to expire old media automatically",
+                parse_mode='Markdown'
+            )
+            return
+        
+        try:
+            report = await asyncio.to_thread(self.retention_report, self.router.shards_for(update.effective_chat.id))
+            report_text = "🧹 **Retention Rules** (dry run)\n\n"
+            for rule, count, size in report:
+                report_text += f"📁 {rule.describe()}\n   🗑️ Due now: {count} files ({format_file_size(size)})\n"
+            
+            report_text += (
+                f"\n⏱️ **Runs every:** {RETENTION_INTERVAL // 60} min"
+                f"{' (dry run only)' if RETENTION_DRY_RUN else ''}\n"
+                f"📈 **Expired so far:** {self.metrics['retention_expired']} files "
+                f"({format_file_size(self.metrics['retention_bytes'])}) in {self.metrics['retention_runs']} runs"
+            )
+            if not self.retention_scheduled:
+                report_text += "\n⚠️ JobQueue not installed, expiry is not scheduled"
+            
+            await update.message.reply_text(report_text, parse_mode='Markdown')
+            
+        except Exception as e:
+            logger.error("Retention report error: %s", e)
+            await update.message.reply_text("❌ Error building the retention report")
+
+    async def profile_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Sample live traffic for a few seconds and reply with a folded flame graph"""
+        if update.effective_user.id not in ADMIN_USER_IDS:
+            await update.message.reply_text("⛔ **Only bot admins can run the profiler.**", parse_mode='Markdown')
+            return
+        if self.profiler is not None:
+            await update.message.reply_text("⏳ **A profile is already running.** Try again when it finishes.", parse_mode='Markdown')
+            return
+        
+        try:
+            seconds = int(context.args[0]) if context.args else 10
+        except ValueError:
+            await update.message.reply_text(
+                "🔬 **Usage:** `/profile <seconds>`\n"
+                f"Example: `/profile 30` (at most {PROFILE_MAX_SECONDS})",
+                parse_mode='Markdown'
+            )
+            return
+        seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+        
+        await update.message.reply_text(f"🔬 **Profiling for {seconds}s...**", parse_mode='Markdown')
+        self.profiler = profiler = SamplingProfiler()
+        profiler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            await asyncio.to_thread(profiler.stop)
+            self.profiler = None
+        
+        caption = (
+            f"🔥 **Profile:** {seconds}s, {profiler.samples} samples, {len(profiler.stacks)} stacks\n"
+            f"🐢 **Loop stalls:** "
+            f"{f'{self.watchdog.stalls} (longest {self.watchdog.max_lag:.2f}s)' if self.watchdog else 'watchdog off'}\n"
+            f"💡 Open with speedscope.app or flamegraph.pl"
+        )
+        await update.message.reply_document(
+            document=profiler.folded().encode(),
+            filename=f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.folded",
+            caption=caption,
+            parse_mode='Markdown'
+        )
+
+    @staticmethod
+    def parse_broadcast_args(args):
+        """Split /broadcast arguments into (query, chat targets)
+        
+        Targets are the trailing arguments made only of chat ids and
+        @channel names, separated by spaces and/or commas.
+        """
+        args = list(args)
+        targets = []
+        while len(args) > 1:
+            tokens = [token for token in args[-1].split(',') if token]
+            if not tokens or not all(token.lstrip('-').isdigit() or token.startswith('@') for token in tokens):
+                break
+            targets[:0] = [int(token) if token.lstrip('-').isdigit() else token for token in tokens]
+            args.pop()
+        return ' '.join(args), list(dict.fromkeys(targets))
+
+    def broadcast_records(self, shards, query):
+        """Media to broadcast: the exact filename, else up to BROADCAST_MAX_FILES matches in save order"""
+        columns = '''
+            SELECT m.saved_filename, m.file_path, m.media_type, m.file_size, m.caption,
+                   u.first_name AS user_first_name, m.save_date, m.size_text, m.date_text
+            FROM saved_media m
+            LEFT JOIN users u ON u.user_id = m.user_id
+        '''
+        records = self.query_media(shards, columns + 'WHERE m.saved_filename = ?', (query,), limit=1)
+        if not records:
+            records = self.query_media(shards, columns + '''
+                WHERE m.saved_filename LIKE ? OR m.caption LIKE ?
+                ORDER BY m.save_date DESC
+                LIMIT ?
+            ''', (f'%{query}%', f'%{query}%', BROADCAST_MAX_FILES), limit=BROADCAST_MAX_FILES)
+        records.sort(key=lambda record: record.save_date)
+        return records
+
+    async def broadcast_to(self, context, chat_id, records, limiter):
+        """Deliver every record to one chat, retrying transient failures; returns None or the error text"""
+        delivered = 0
+        for attempt in range(BROADCAST_RETRIES + 1):
+            try:
+                while delivered < len(records):
+                    record = records[delivered]
+                    await limiter.wait()
+                    await self.deliver_media(context, chat_id, record, self.render_media_caption(record), action=None)
+                    delivered += 1
+                return None
+            except RetryAfter as e:
+                # Flood wait: pause the whole fan-out, not just this chat
+                delay = e.retry_after
+                if isinstance(delay, timedelta):
+                    delay = delay.total_seconds()
+                limiter.next_slot = max(limiter.next_slot, time.monotonic() + delay)
+                error = f"flood wait {delay:.0f}s"
+            except (BadRequest, Forbidden) as e:
+                # Unknown chat, bot blocked or not a member: retrying won't help
+                return e.message
+            except NetworkError as e:
+                await asyncio.sleep(2 ** attempt)
+                error = e.message
+            except Exception as e:
+                logger.error("Broadcast to %s failed: %s", chat_id, e)
+                return str(e)
+            logger.warning("Broadcast to %s failed (attempt %s): %s", chat_id, attempt + 1, error)
+        return error
+
+    async def broadcast_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Send saved media to a list of chats, uploading each file once"""
+        if update.effective_user.id not in ADMIN_USER_IDS:
+            await update.message.reply_text("⛔ **Only bot admins can broadcast.**", parse_mode='Markdown')
+            return
+        
+        query, targets = self.parse_broadcast_args(context.args)
+        if not query or not targets:
+            await update.message.reply_text(
+                "📣 **Usage:** `/broadcast <filename|query> <chats>`\n"
+                "Chats are ids or @channel names, separated by spaces or commas\n"
+                "Example: `/broadcast 20241129_143022_video.mp4 -1001234567890,@mychannel`",
+                parse_mode='Markdown'
+            )
+            return
+        if len(targets) > BROADCAST_MAX_TARGETS:
+            await update.message.reply_text(f"❌ At most {BROADCAST_MAX_TARGETS} chats per broadcast.")
+            return
+        
+        shards = self.router.shards_for(update.effective_chat.id)
+        records = await asyncio.to_thread(self.broadcast_records, shards, query)
+        records = [record for record in records if Path(record.file_path).exists()]
+        if not records:
+            await update.message.reply_text(f"🔍 No saved media found for: `{query}`", parse_mode='Markdown')
+            return
+        
+        progress = await update.message.reply_text(
+            f"📣 **Broadcasting {len(records)} media to {len(targets)} chats...**",
+            parse_mode='Markdown'
+        )
+        started = time.perf_counter()
+        uncached = [record for record in records if record.media_key not in self.sent_file_ids]
+        limiter = RateLimiter(BROADCAST_RATE)
+        semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        failures = {}
+        done = 0
+        last_progress = time.monotonic()
+        
+        async def send_one(chat_id):
+            nonlocal done, last_progress
+            async with semaphore:
+                error = await self.broadcast_to(context, chat_id, records, limiter)
+            if error:
+                failures[chat_id] = error
+            done += 1
+            
+            # Throttled progress updates
+            if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                try:
+                    await progress.edit_text(
+                        f"📣 **Broadcasting...** {done}/{len(targets)} chats",
+                        parse_mode='Markdown'
+                    )
+                except Exception as e:
+                    logger.warning("Progress update failed: %s", e)
+        
+        # Chats go one at a time until every media has a file_id, then fan out
+        remaining = list(targets)
+        while remaining and any(record.media_key not in self.sent_file_ids for record in records):
+            await send_one(remaining.pop(0))
+        await asyncio.gather(*(send_one(chat_id) for chat_id in remaining))
+        
+        duration = time.perf_counter() - started
+        # Uploads that actually produced a reusable file_id
+        uploads = sum(1 for record in uncached if record.media_key in self.sent_file_ids)
+        audit('broadcast', files=[record.saved_filename for record in records], targets=len(targets),
+              failed=len(failures), uploads=uploads, user_id=update.effective_user.id,
+              duration_ms=round(duration * 1000, 1))
+        
+        report_text = (
+            f"📣 **Broadcast finished** in {duration:.1f}s\n\n"
+            f"📁 **Media:** {len(records)}\n"
+            f"📤 **Uploads:** {uploads} of {len(uncached)} needed, every other send reused a file_id\n"
+            f"✅ **Delivered:** {len(targets) - len(failures)}/{len(targets)} chats"
+        )
+        if failures:
+            report_text += f"\n❌ **Failed:** {len(failures)}\n"
+            for chat_id, error in list(failures.items())[:20]:
+                report_text += f"• `{chat_id}`: {error}\n"
+            if len(failures) > 20:
+                report_text += f"... and {len(failures) - 20} more\n"
+        try:
+            await progress.edit_text(report_text, parse_mode='Markdown')
+        except Exception as e:
+            logger.warning("Broadcast report edit failed: %s", e)
+            await update.message.reply_text(report_text)
+
+    def change_log_versions(self):
+        """shard_id -> last change_log seq, the version a snapshot is taken against"""
+        versions = {}
+        for shard in self.router.shards.values():
+            conn = sqlite3.connect(shard.db_path)
+            try:
+                versions[shard.shard_id] = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM change_log').fetchone()[0]
+            finally:
+                conn.close()
+        return versions
+
+    def open_snapshot(self):
+        """Map the last snapshot and work out which of its entries are still valid
+        
+        A shard whose change_log moved past the snapshot's seq only loses the
+        media changed since then; a shard missing from the snapshot, or whose
+        log went backwards (restored or rebuilt), loses everything.
+        """
+        snapshot = CatalogSnapshot.open(self.snapshot_path)
+        if snapshot is None:
+            return None, {}
+        if snapshot.header.get('schema_version') != SCHEMA_VERSION:
+            logger.info("Catalog snapshot is from schema v%s, starting cold", snapshot.header.get('schema_version'))
+            snapshot.close()
+            return None, {}
+        
+        stale = {}
+        for shard in self.router.shards.values():
+            seq = snapshot.header['shards'].get(str(shard.shard_id))
+            conn = sqlite3.connect(shard.db_path)
+            try:
+                current = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM change_log').fetchone()[0]
+                if seq is None or current < seq:
+                    continue
+                changed = conn.execute('SELECT DISTINCT file_path FROM change_log WHERE seq > ?', (seq,)).fetchall()
+            finally:
+                conn.close()
+            stale[shard.shard_id] = {Path(file_path).name for (file_path,) in changed if file_path}
+        return snapshot, stale
+
+    def snapshot_valid(self, media_key):
+        """Whether snapshot entries for a media (or for pages, when None) are still current"""
+        if media_key is None:
+            return len(self.snapshot_stale) == len(self.router.shards) and not any(self.snapshot_stale.values())
+        shard_id, saved_filename = media_key
+        stale = self.snapshot_stale.get(shard_id)
+        # Variants are keyed "<saved_filename>@<variant>"; other names may contain '@' themselves
+        base, _, variant = saved_filename.rpartition('@')
+        if not base or variant not in IMAGE_VARIANTS:
+            base = saved_filename
+        return stale is not None and base not in stale
+
+    def snapshot_lookup(self, section, key, media_key):
+        """Cache fallback: a still-valid snapshot value or None"""
+        if not self.snapshot_valid(media_key):
+            return None
+        return self.snapshot.get(section, key)
+
+    async def load_snapshot(self):
+        """Attach the last snapshot as a lazy fallback behind the in-memory caches"""
+        started = time.perf_counter()
+        self.snapshot, self.snapshot_stale = await asyncio.to_thread(self.open_snapshot)
+        if self.snapshot is None:
+            return
+        
+        self.sent_file_ids.fallback = lambda key: self.snapshot_lookup('file_ids', key, key)
+        self.render_cache.fallback = lambda key: self.snapshot_lookup('render', key, key[0])
+        
+        # Recent log group media is small and needed as a whole for album saves
+        for chat_id, items in self.snapshot.items('recent'):
+            seen = OrderedDict(
+                (message_id, (MediaRecord(**record), media_group_id, timestamp))
+                for message_id, record, media_group_id, timestamp in items
+            )
+            seen.update(self.recent_media.get(chat_id, {}))
+            self.recent_media[chat_id] = seen
+        
+        stale = sum(len(names) for names in self.snapshot_stale.values())
+        logger.info("Catalog snapshot loaded in %.1f ms (%s of %s shards current, %s media changed since)",
+                    (time.perf_counter() - started) * 1000, len(self.snapshot_stale), len(self.router.shards), stale)
+
+    def snapshot_copy(self):
+        """Shallow copies of the live caches; runs on the loop so the copy is consistent"""
+        return {
+            'file_ids': dict(dict.items(self.sent_file_ids)),
+            'file_ids_blocked': set(self.sent_file_ids.blocked) if self.sent_file_ids.fallback is not None else None,
+            'render': dict(self.render_cache.entries),
+            'render_blocked': set(self.render_cache.blocked) if self.render_cache.fallback is not None else None,
+            'recent': {chat_id: list(seen.items()) for chat_id, seen in self.recent_media.items()}
+        }
+
+    def write_snapshot(self, header, copy):
+        """Merge a cache copy with the still-valid part of the last snapshot and write it (worker thread)"""
+        with self.snapshot_lock:
+            file_ids, render = copy['file_ids'], copy['render']
             
-        for unit in ['B', 'KB', 'MB', 'GB']:
-            if size_bytes < 1024.0:
-                return f"{size_bytes:.1f} {unit}"
-            size_bytes /= 1024.0
-        return f"{size_bytes:.1f} TB"
+            # Carry over still-valid entries that were never touched in this process
+            if self.snapshot is not None:
+                if copy['file_ids_blocked'] is not None:
+                    for key, value in self.snapshot.items('file_ids'):
+                        if key not in file_ids and key not in copy['file_ids_blocked'] and self.snapshot_valid(key):
+                            file_ids[key] = value
+                if copy['render_blocked'] is not None:
+                    for key, value in self.snapshot.items('render'):
+                        if key not in render and key[0] not in copy['render_blocked'] and self.snapshot_valid(key[0]):
+                            render[key] = value
+            
+            recent = [
+                (chat_id, [
+                    (message_id, {field: value for field, value in asdict(record).items() if value is not None},
+                     media_group_id, timestamp)
+                    for message_id, (record, media_group_id, timestamp) in items
+                ])
+                for chat_id, items in copy['recent'].items()
+            ]
+            return CatalogSnapshot.write(
+                self.snapshot_path, header, {'file_ids': file_ids.items(), 'render': render.items(), 'recent': recent}
+            )
+
+    def close_snapshot(self):
+        """Unmap the last snapshot once no write is reading it"""
+        with self.snapshot_lock:
+            self.snapshot.close()
+
+    async def save_snapshot(self):
+        """Write a fresh catalog snapshot without blocking the loop"""
+        if self.snapshot_path is None:
+            return
+        started = time.perf_counter()
+        # Versions are read before copying, so anything changed meanwhile is treated as stale next boot
+        versions = await asyncio.to_thread(self.change_log_versions)
+        copy = self.snapshot_copy()
+        header = {
+            'schema_version': SCHEMA_VERSION,
+            'created': int(time.time()),
+            'shards': {str(shard_id): seq for shard_id, seq in versions.items()}
+        }
+        size = await asyncio.to_thread(self.write_snapshot, header, copy)
+        logger.info("Catalog snapshot written: %s in %.1f ms",
+                    format_file_size(size), (time.perf_counter() - started) * 1000)
+
+    async def try_save_snapshot(self):
+        """Write a snapshot, logging rather than raising on failure"""
+        try:
+            await self.save_snapshot()
+        except Exception as e:
+            logger.error("Catalog snapshot failed: %s", e)
+
+    async def snapshot_loop(self):
+        """Periodic snapshots so a crash still restarts warm
+        
+        A plain task rather than a JobQueue job: snapshots are on by default
+        and shouldn't need the job-queue extra.
+        """
+        while True:
+            await asyncio.sleep(SNAPSHOT_INTERVAL)
+            await self.try_save_snapshot()
+
+    async def post_init(self, application):
+        """Start the loop watchdog and load the catalog snapshot once the event loop is running"""
+        if self.watchdog is not None:
+            self.watchdog.start(asyncio.get_running_loop())
+        
+        if self.snapshot_path is not None:
+            await self.load_snapshot()
+            self.snapshot_task = asyncio.create_task(self.snapshot_loop())
+
+    async def post_shutdown(self, application):
+        """Snapshot the caches and commit any buffered writes before exiting"""
+        if self.watchdog is not None:
+            self.watchdog.stop()
+        
+        if self.snapshot_task is not None:
+            self.snapshot_task.cancel()
+            # Buffered writes must land first so the snapshot's versions cover them
+            for shard in self.router.shards.values():
+                await asyncio.wrap_future(shard.writer.flush())
+            await self.try_save_snapshot()
+        if self.snapshot is not None:
+            await asyncio.to_thread(self.close_snapshot)
+        
+        await asyncio.to_thread(self.router.close)
+        logger.info("Write-behind buffer flushed")
+        
+        if self.hash_pool is not None:
+            self.hash_pool.shutdown(cancel_futures=True)
+        
+        if self.recorder is not None:
+            self.recorder.close()
 
     def run(self):
         """Start the bot"""
         logger.info("Starting Reply Save Bot...")
-        logger.info(f"Log Group ID: {LOG_GROUP_ID}")
+        logger.info("Log Group IDs: %s", LOG_GROUP_IDS)
         print(f"🤖 Bot is running...")
-        print(f"📱 Log Group ID: {LOG_GROUP_ID}")
-        print(f"💾 Media will be saved to: {self.base_dir}")
+        print(f"📱 Log Group IDs: {', '.join(str(chat_id) for chat_id in LOG_GROUP_IDS)}")
+        for shard in self.router.shards.values():
+            print(f"💾 Shard {shard.shard_id}: media saved to {shard.base_dir}")
         print("🔄 Media retrieval feature enabled")
         print("Press Ctrl+C to stop")
         
         self.application.run_polling()
 
+class Progress:
+    """Throttled single-line progress report on stderr"""
+
+    def __init__(self, label, total=None, interval=PROGRESS_INTERVAL):
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.count = 0
+        self.started = self.last_report = time.monotonic()
+
+    def update(self, count=1):
+        self.count += count
+        now = time.monotonic()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report(end='\r')
+
+    def report(self, end='\n'):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        total = f"/{self.total}" if self.total is not None else ""
+        print(f"{self.label}: {self.count}{total} ({self.count / elapsed:.0f}/s)", end=end, file=sys.stderr, flush=True)
+
+    def done(self):
+        self.report()
+
+class ArchiveAdmin:
+    """Offline maintenance of the shard databases and media roots, no bot needed"""
+
+    def __init__(self, router, batch_size=ADMIN_BATCH_SIZE, workers=HASH_WORKERS):
+        self.router = router
+        self.batch_size = batch_size
+        self.workers = workers
+
+    def select_shards(self, shard_id=None):
+        """Owned shards, or just the requested one, migrated and ready"""
+        if shard_id is None:
+            shards = list(self.router.shards.values())
+        elif shard_id in self.router.shards:
+            shards = [self.router.shards[shard_id]]
+        else:
+            raise SystemExit(f"Unknown or unowned shard: {shard_id}")
+        for shard in shards:
+            shard.prepare()
+        return shards
+
+    def connect(self, shard):
+        """Autocommit connection; batches open their own transactions"""
+        conn = sqlite3.connect(shard.db_path, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA recursive_triggers=ON')
+        return conn
+
+    def run_batches(self, conn, statement_batches):
+        """Execute lists of statements, committing every batch_size items"""
+        pending = 0
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for statements in statement_batches:
+                for sql, params in statements:
+                    conn.execute(sql, params)
+                pending += 1
+                if pending >= self.batch_size:
+                    conn.execute('COMMIT')
+                    conn.execute('BEGIN IMMEDIATE')
+                    pending = 0
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def is_internal_file(self, path):
+        """Whether a file is the bot's own bookkeeping: audit log rotations or the catalog snapshot"""
+        internal = []
+        if AUDIT_LOG_FILE:
+            internal.append(Path(AUDIT_LOG_FILE))
+        if SNAPSHOT_FILE:
+            internal.append(self.router.root / SNAPSHOT_FILE)
+        return any(
+            path.parent.resolve() == internal_path.parent.resolve() and path.name.startswith(internal_path.name)
+            for internal_path in internal
+        )
+
+    def import_media_type(self, shard, path):
+        """Media type from the shard subdirectory a file sits in, else its extension"""
+        parent = path.parent.resolve()
+        for media_type, directory in shard.media_dirs.items():
+            if parent == directory.resolve():
+                return media_type
+        return IMPORT_EXTENSIONS.get(path.suffix.lower(), 'document')
+
+    def import_directory(self, shard, source, move=False):
+        """Register every file under source, copying it into the shard unless it is already there"""
+        source = Path(source)
+        conn = self.connect(shard)
+        try:
+            # Files already registered by path (stored relative to the bot's working
+            # directory, so compare resolved) or, for earlier imports, by content
+            known_paths = {str(Path(row[0]).resolve()) for row in conn.execute('SELECT file_path FROM saved_media')}
+            known_ids = {row[0] for row in conn.execute("SELECT file_id FROM saved_media WHERE file_id LIKE 'import:%'")}
+            skipped_dirs = self.skipped_dirs(shard)
+            
+            files = []
+            for path in sorted(source.rglob('*')):
+                if not path.is_file():
+                    continue
+                resolved = path.resolve()
+                if str(resolved) in known_paths or any(resolved.is_relative_to(directory) for directory in skipped_dirs):
+                    continue
+                # Skip the database itself, its -wal/-shm files and the audit log
+                if path.name.startswith(shard.db_path.name) or self.is_internal_file(path):
+                    continue
+                files.append((path, self.import_media_type(shard, path)))
+            
+            progress = Progress("Importing", len(files))
+            stats = {'imported': 0, 'duplicates': 0, 'failed': 0}
+            
+            def records():
+                with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as pool:
+                    hashes = pool.map(
+                        hash_media_file,
+                        [str(path) for path, _ in files],
+                        [media_type for _, media_type in files],
+                        chunksize=64
+                    )
+                    for (path, media_type), result in zip(files, hashes):
+                        progress.update()
+                        file_id = f"import:{result[0]}"
+                        if file_id in known_ids:
+                            stats['duplicates'] += 1
+                            continue
+                        try:
+                            record = self.place_imported_file(shard, path, media_type, file_id, result, move)
+                        except OSError as e:
+                            logger.error("Could not import %s: %s", path, e)
+                            stats['failed'] += 1
+                            continue
+                        known_ids.add(file_id)
+                        stats['imported'] += 1
+                        yield media_record_statements(record)
+            
+            self.run_batches(conn, records())
+            progress.done()
+            return stats
+        finally:
+            conn.close()
+
+    def skipped_dirs(self, shard):
+        """Resolved trees that aren't this shard's media: other shards and its derived variants"""
+        base_dir = shard.base_dir.resolve()
+        return [
+            directory for directory in (
+                (self.router.root / "groups").resolve(), (self.router.root / "shards").resolve()
+            )
+            if not base_dir.is_relative_to(directory)
+        ] + [(shard.base_dir / "variants").resolve()]
+
+    def place_imported_file(self, shard, path, media_type, file_id, hash_result, move):
+        """Copy or move a file into its media directory and describe it as a MediaRecord"""
+        _, file_size, mtime, dhash = hash_result
+        directory = shard.media_dirs[media_type]
+        if path.parent.resolve() == directory.resolve():
+            file_path = directory / path.name
+        else:
+            file_path = directory / path.name
+            counter = 1
+            while file_path.exists():
+                file_path = directory / f"{path.stem}_{counter}{path.suffix}"
+                counter += 1
+            if move:
+                shutil.move(path, file_path)
+            else:
+                shutil.copy2(path, file_path)
+        
+        return MediaRecord(
+            media_type=media_type,
+            file_id=file_id,
+            saved_filename=file_path.name,
+            file_path=str(file_path),
+            file_size=file_size,
+            original_filename=path.name,
+            mime_type=mimetypes.guess_type(path.name)[0],
+            save_date=mtime,
+            size_text=format_file_size(file_size),
+            date_text=format_save_date(mtime),
+            dhash=dhash
+        )
+
+    def reindex(self, shard, rehash=False):
+        """Rebuild indexes, display fields and missing (or all) photo hashes"""
+        conn = self.connect(shard)
+        try:
+            print(f"Rebuilding indexes of {shard.db_path}...", file=sys.stderr)
+            conn.execute('REINDEX')
+            
+            rows = conn.execute('SELECT id, file_size, save_date FROM saved_media').fetchall()
+            progress = Progress("Display fields", len(rows))
+            
+            def display_updates():
+                for row_id, file_size, save_date in rows:
+                    progress.update()
+                    yield [(
+                        'UPDATE saved_media SET size_text = ?, date_text = ? WHERE id = ?',
+                        (format_file_size(file_size or 0), format_save_date(save_date), row_id)
+                    )]
+            
+            self.run_batches(conn, display_updates())
+            progress.done()
+            
+            if np is not None and Image is not None:
+                self.rehash_photos(conn, rehash)
+            conn.execute('ANALYZE')
+        finally:
+            conn.close()
+
+    def rehash_photos(self, conn, rehash):
+        """Compute photo hashes on the process pool and store them in batches"""
+        missing = '' if rehash else 'AND id NOT IN (SELECT media_id FROM photo_hashes)'
+        photos = conn.execute(f"SELECT id, file_path FROM saved_media WHERE media_type = 'photo' {missing}").fetchall()
+        photos = [(row_id, file_path) for row_id, file_path in photos if file_path and os.path.exists(file_path)]
+        progress = Progress("Photo hashes", len(photos))
+        
+        def hash_updates():
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as pool:
+                futures = {pool.submit(compute_dhash, file_path): row_id for row_id, file_path in photos}
+                for future in concurrent.futures.as_completed(futures):
+                    progress.update()
+                    try:
+                        dhash = future.result()
+                    except Exception as e:
+                        logger.warning("Could not hash media %s: %s", futures[future], e)
+                        continue
+                    yield [(
+                        'INSERT OR REPLACE INTO photo_hashes (media_id, dhash, b0, b1, b2, b3) VALUES (?, ?, ?, ?, ?, ?)',
+                        (futures[future], to_signed64(dhash), *dhash_bands(dhash))
+                    )]
+        
+        self.run_batches(conn, hash_updates())
+        progress.done()
+
+    def vacuum(self, shard):
+        """Checkpoint the WAL, VACUUM and ANALYZE, returning the size before and after"""
+        before = shard.db_path.stat().st_size
+        conn = self.connect(shard)
+        try:
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            conn.execute('VACUUM')
+            conn.execute('ANALYZE')
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        finally:
+            conn.close()
+        return before, shard.db_path.stat().st_size
+
+    def verify(self, shard, quick=False, prune=False):
+        """Check database integrity and that rows and media files match up"""
+        problems = {}
+        conn = self.connect(shard)
+        try:
+            check = 'quick_check' if quick else 'integrity_check'
+            result = [row[0] for row in conn.execute(f'PRAGMA {check}')]
+            if result != ['ok']:
+                problems['integrity'] = result
+            foreign_keys = conn.execute('PRAGMA foreign_key_check').fetchall()
+            if foreign_keys:
+                problems['foreign_keys'] = foreign_keys
+            
+            rows = conn.execute('SELECT id, file_path, file_size FROM saved_media').fetchall()
+            progress = Progress("Checking files", len(rows))
+            missing, size_mismatch, referenced = [], [], set()
+            for row_id, file_path, file_size in rows:
+                progress.update()
+                referenced.add(os.path.abspath(file_path or ''))
+                try:
+                    actual_size = os.stat(file_path).st_size
+                except (OSError, TypeError):
+                    missing.append((row_id, file_path))
+                    continue
+                if file_size is not None and actual_size != file_size:
+                    size_mismatch.append((file_path, file_size, actual_size))
+            progress.done()
+            
+            orphans = [
+                str(path) for directory in shard.media_dirs.values() if directory.exists()
+                for path in directory.iterdir()
+                if path.is_file() and os.path.abspath(path) not in referenced
+            ]
+            for name, found in (('missing_files', missing), ('size_mismatch', size_mismatch), ('orphan_files', orphans)):
+                if found:
+                    problems[name] = found
+            
+            if prune and missing:
+                self.run_batches(conn, ([('DELETE FROM saved_media WHERE id = ?', (row_id,))] for row_id, _ in missing))
+                print(f"Pruned {len(missing)} rows without files", file=sys.stderr)
+        finally:
+            conn.close()
+        return problems
+
+    def stats(self, shard):
+        """Counts and sizes by media type plus database file statistics"""
+        conn = self.connect(shard)
+        try:
+            by_type = conn.execute('''
+                SELECT media_type, COUNT(*), COALESCE(SUM(file_size), 0)
+                FROM saved_media GROUP BY media_type ORDER BY COUNT(*) DESC
+            ''').fetchall()
+            hashed = conn.execute('SELECT COUNT(*) FROM photo_hashes').fetchone()[0]
+            users = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+            page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+            page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+            freelist = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+        finally:
+            conn.close()
+        return {
+            'by_type': by_type,
+            'photo_hashes': hashed,
+            'users': users,
+            'schema_version': version,
+            'db_size': page_size * page_count,
+            'free_size': page_size * freelist
+        }
+
+class ArchiveBackup:
+    """Online backups, incremental media sync and portable archive export/restore
+    
+    Databases are copied with the SQLite backup API a few pages at a time, so
+    the bot keeps writing during a backup. Media files are synced from each
+    database's change log; paths inside backups and exports are relative to
+    the router root, so the same layout restores anywhere.
+    """
+
+    MANIFEST_NAME = "manifest.jsonl"
+    SYNC_STATE_NAME = "sync_state.json"
+
+    def __init__(self, router, pages=BACKUP_PAGES_PER_STEP, sleep=BACKUP_STEP_SLEEP):
+        self.router = router
+        self.pages = pages
+        self.sleep = sleep
+
+    def relative_path(self, path):
+        """Path relative to the router root, None for files outside it"""
+        relative = os.path.relpath(path, self.router.root)
+        if relative.startswith('..') or os.path.isabs(relative):
+            return None
+        return relative
+
+    def backup_database(self, shard, dest_path, journal_mode=None):
+        """Copy a live shard database page-stepped, replacing dest_path atomically"""
+        dest_path = Path(dest_path)
+        dest_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = dest_path.with_name(dest_path.name + ".tmp")
+        progress = Progress(f"Backing up {shard.db_path}")
+        
+        def report(status, remaining, total):
+            progress.total = total
+            progress.count = total - remaining
+            progress.update(0)
+            # Called after every step; backup(sleep=...) alone only waits when a step is busy
+            if remaining:
+                time.sleep(self.sleep)
+        
+        source = sqlite3.connect(shard.db_path)
+        target = sqlite3.connect(tmp_path)
+        try:
+            source.backup(target, pages=self.pages, progress=report, sleep=self.sleep)
+            if journal_mode:
+                target.execute(f'PRAGMA journal_mode={journal_mode}')
+        finally:
+            target.close()
+            source.close()
+        for suffix in ('-wal', '-shm'):
+            dest_path.with_name(dest_path.name + suffix).unlink(missing_ok=True)
+        os.replace(tmp_path, dest_path)
+        progress.done()
+        return dest_path
+
+    def backup(self, shard, dest_root):
+        """Back up a shard's database, then sync its media up to that snapshot"""
+        dest_root = Path(dest_root)
+        snapshot = self.backup_database(shard, dest_root / self.relative_path(shard.db_path))
+        return self.sync_media(snapshot, dest_root)
+
+    def sync_media(self, snapshot, dest_root):
+        """Apply change log entries newer than the last sync to the media under dest_root"""
+        state_path = Path(snapshot).with_name(self.SYNC_STATE_NAME)
+        last_seq = json.loads(state_path.read_text())['last_seq'] if state_path.exists() else 0
+        
+        conn = sqlite3.connect(snapshot)
+        try:
+            changes = conn.execute(
+                'SELECT seq, op, file_path FROM change_log WHERE seq > ? ORDER BY seq', (last_seq,)
+            ).fetchall()
+        finally:
+            conn.close()
+        
+        # Only the latest operation on each path matters
+        latest = {}
+        for seq, op, file_path in changes:
+            if file_path:
+                latest[file_path] = op
+            last_seq = seq
+        
+        progress = Progress("Syncing media", len(latest))
+        stats = {'copied': 0, 'removed': 0, 'missing': 0}
+        for file_path, op in latest.items():
+            progress.update()
+            relative = self.relative_path(file_path)
+            if relative is None:
+                logger.warning("Not backing up %s: outside %s", file_path, self.router.root)
+                continue
+            target = Path(dest_root) / relative
+            if op == 'delete':
+                if target.exists():
+                    target.unlink()
+                    stats['removed'] += 1
+                continue
+            try:
+                source_stat = os.stat(file_path)
+            except OSError:
+                # Deleted after the snapshot was taken, a later sync records it
+                stats['missing'] += 1
+                continue
+            if target.exists() and target.stat().st_size == source_stat.st_size and target.stat().st_mtime >= source_stat.st_mtime:
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(file_path, target)
+            stats['copied'] += 1
+        progress.done()
+        
+        tmp_path = state_path.with_name(state_path.name + ".tmp")
+        tmp_path.write_text(json.dumps({'last_seq': last_seq, 'synced_at': int(time.time())}))
+        os.replace(tmp_path, state_path)
+        return stats
+
+    def export(self, shards, out, archive_format='tar'):
+        """Stream snapshots, media and a manifest of every shard into a tar or zip file object"""
+        with tempfile.TemporaryDirectory(prefix="midea-export-") as tmp_dir:
+            # Snapshot every database first so the manifest matches what gets exported
+            databases, entries = [], []
+            for shard in shards:
+                database = self.relative_path(shard.db_path)
+                snapshot = self.backup_database(shard, Path(tmp_dir) / database, journal_mode='DELETE')
+                databases.append((database, snapshot))
+                
+                conn = sqlite3.connect(snapshot)
+                try:
+                    rows = conn.execute('SELECT id, file_path FROM saved_media ORDER BY id').fetchall()
+                finally:
+                    conn.close()
+                for media_id, file_path in rows:
+                    relative = self.relative_path(file_path) if file_path else None
+                    if relative is None or not os.path.isfile(file_path):
+                        logger.warning("Not exporting media %s of %s: %s missing", media_id, database, file_path)
+                        continue
+                    entries.append({'database': database, 'media_id': media_id, 'path': relative, 'size': os.path.getsize(file_path), 'source': file_path})
+            
+            manifest_path = Path(tmp_dir) / self.MANIFEST_NAME
+            with open(manifest_path, 'w') as manifest:
+                manifest.write(json.dumps({
+                    'format': 'midea-export',
+                    'version': 1,
+                    'schema_version': SCHEMA_VERSION,
+                    'created': int(time.time()),
+                    'databases': [database for database, _ in databases],
+                    'files': len(entries)
+                }) + "\n")
+                for entry in entries:
+                    manifest.write(json.dumps({key: value for key, value in entry.items() if key != 'source'}) + "\n")
+            
+            # Manifest first and databases next, so a streaming restore knows the layout up front
+            members = [(self.MANIFEST_NAME, manifest_path)] + databases + [(entry['path'], entry['source']) for entry in entries]
+            progress = Progress("Exporting", len(members))
+            if archive_format == 'zip':
+                self.write_zip(out, members, progress)
+            else:
+                self.write_tar(out, members, progress)
+            progress.done()
+        return len(entries)
+
+    def write_tar(self, out, members, progress):
+        """Uncompressed streaming tar, copied with large buffers"""
+        with tarfile.open(fileobj=out, mode='w|', bufsize=EXPORT_BUFFER_SIZE, copybufsize=EXPORT_BUFFER_SIZE) as archive:
+            for name, path in members:
+                archive.add(path, arcname=name, recursive=False)
+                progress.update()
+
+    def write_zip(self, out, members, progress):
+        """Stored (uncompressed) zip, works on unseekable outputs too"""
+        with zipfile.ZipFile(out, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+            for name, path in members:
+                info = zipfile.ZipInfo.from_file(path, arcname=name)
+                with open(path, 'rb') as source, archive.open(info, 'w', force_zip64=True) as target:
+                    shutil.copyfileobj(source, target, EXPORT_BUFFER_SIZE)
+                progress.update()
+
+    def restore(self, archive_path, root, force=False):
+        """Unpack an export under root and point its databases at the restored files"""
+        root = Path(root)
+        header, entries = None, []
+        
+        if zipfile.is_zipfile(archive_path):
+            with zipfile.ZipFile(archive_path) as archive:
+                for name in archive.namelist():
+                    with archive.open(name) as member:
+                        header = self.restore_member(name, member, root, header, entries, force)
+        else:
+            with tarfile.open(archive_path, mode='r|*', bufsize=EXPORT_BUFFER_SIZE) as archive:
+                for member in archive:
+                    if member.isfile():
+                        header = self.restore_member(member.name, archive.extractfile(member), root, header, entries, force)
+        
+        if header is None:
+            raise ValueError(f"{archive_path} has no {self.MANIFEST_NAME}")
+        
+        # Rewrite file paths for the new root, then bring old exports up to date
+        for database in header['databases']:
+            db_path = root / database
+            conn = sqlite3.connect(db_path, isolation_level=None)
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                conn.executemany(
+                    'UPDATE saved_media SET file_path = ? WHERE id = ?',
+                    [(str(root / entry['path']), entry['media_id']) for entry in entries if entry['database'] == database]
+                )
+                conn.execute('COMMIT')
+            finally:
+                conn.close()
+            migrate_database(db_path)
+        return header, len(entries)
+
+    def restore_member(self, name, source, root, header, entries, force):
+        """Restore one archive member, reading the manifest when it comes first"""
+        if name == self.MANIFEST_NAME:
+            lines = iter(source.read().decode().splitlines())
+            header = json.loads(next(lines))
+            if header.get('format') != 'midea-export':
+                raise ValueError("Not a midea export")
+            if header['schema_version'] > SCHEMA_VERSION:
+                raise RuntimeError(f"Export schema v{header['schema_version']} is newer than this bot (v{SCHEMA_VERSION})")
+            entries.extend(json.loads(line) for line in lines)
+            for database in header['databases']:
+                if (root / database).exists() and not force:
+                    raise FileExistsError(f"{root / database} exists, restore with --force to overwrite it")
+            return header
+        
+        if header is None:
+            raise ValueError(f"{self.MANIFEST_NAME} must be the first archive member")
+        target = (root / name).resolve()
+        if not target.is_relative_to(root.resolve()):
+            raise ValueError(f"Refusing to restore {name} outside {root}")
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if name in header['databases']:
+            # A leftover WAL from the old database would be replayed into the restored one
+            for suffix in ('-wal', '-shm'):
+                target.with_name(target.name + suffix).unlink(missing_ok=True)
+        with open(target, 'wb') as output:
+            shutil.copyfileobj(source, output, EXPORT_BUFFER_SIZE)
+        return header
+
+def admin_main(argv):
+    """Entry point of `python midea.py admin ...`"""
+    parser = argparse.ArgumentParser(prog="midea admin", description="Offline archive maintenance")
+    parser.add_argument('--shard', type=int, help="Shard id to work on (default: every owned shard)")
+    parser.add_argument('--batch-size', type=int, default=ADMIN_BATCH_SIZE, help="Rows per transaction")
+    parser.add_argument('--workers', type=int, default=HASH_WORKERS, help="Hashing processes (default: every CPU)")
+    commands = parser.add_subparsers(dest='command', required=True)
+    
+    import_parser = commands.add_parser('import', help="Register existing files, copying them into the shard")
+    import_parser.add_argument('directories', nargs='+', type=Path)
+    import_parser.add_argument('--move', action='store_true', help="Move files instead of copying them")
+    reindex_parser = commands.add_parser('reindex', help="Rebuild indexes, display fields and photo hashes")
+    reindex_parser.add_argument('--rehash', action='store_true', help="Recompute every photo hash, not just missing ones")
+    commands.add_parser('vacuum', help="Compact the database and refresh planner statistics")
+    verify_parser = commands.add_parser('verify', help="Check integrity and rows against media files")
+    verify_parser.add_argument('--quick', action='store_true', help="Use quick_check instead of integrity_check")
+    verify_parser.add_argument('--prune', action='store_true', help="Delete rows whose file is missing")
+    commands.add_parser('stats', help="Show archive statistics")
+    backup_parser = commands.add_parser('backup', help="Online backup of databases plus incremental media sync")
+    backup_parser.add_argument('destination', type=Path)
+    export_parser = commands.add_parser('export', help="Stream databases, media and a manifest into one archive")
+    export_parser.add_argument('output', help="Archive path, or - for stdout")
+    export_parser.add_argument('--format', choices=('tar', 'zip'), default='tar')
+    restore_parser = commands.add_parser('restore', help="Restore an export under the media root")
+    restore_parser.add_argument('archive', type=Path)
+    restore_parser.add_argument('--root', type=Path, default=MEDIA_ROOT, help="Where to restore (default: the media root)")
+    restore_parser.add_argument('--force', action='store_true', help="Overwrite existing databases")
+    args = parser.parse_args(argv)
+    
+    router = ShardRouter(MEDIA_ROOT, LOG_GROUP_IDS, SHARD_COUNT, OWNED_SHARDS)
+    admin = ArchiveAdmin(router, batch_size=args.batch_size, workers=args.workers)
+    archive_backup = ArchiveBackup(router)
+    
+    if args.command == 'restore':
+        try:
+            header, files = archive_backup.restore(args.archive, args.root, force=args.force)
+        except (OSError, ValueError, RuntimeError) as e:
+            raise SystemExit(f"Restore failed: {e}")
+        print(f"Restored {len(header['databases'])} databases and {files} files under {args.root}")
+        return 0
+    
+    if args.command == 'export':
+        shards = admin.select_shards(args.shard)
+        if args.output == '-':
+            files = archive_backup.export(shards, sys.stdout.buffer, args.format)
+        else:
+            with open(args.output, 'wb') as out:
+                files = archive_backup.export(shards, out, args.format)
+        print(f"Exported {len(shards)} databases and {files} files", file=sys.stderr)
+        return 0
+    
+    if args.command == 'import':
+        # Imports go to one shard: the requested one or the first owned
+        shard = admin.select_shards(args.shard)[0]
+        for directory in args.directories:
+            stats = admin.import_directory(shard, directory, move=args.move)
+            print(f"{directory}: {stats['imported']} imported, {stats['duplicates']} duplicates, {stats['failed']} failed")
+        return 0
+    
+    status = 0
+    for shard in admin.select_shards(args.shard):
+        print(f"Shard {shard.shard_id} ({shard.base_dir})")
+        if args.command == 'reindex':
+            admin.reindex(shard, rehash=args.rehash)
+            print("  Reindexed")
+        elif args.command == 'vacuum':
+            before, after = admin.vacuum(shard)
+            print(f"  {format_file_size(before)} -> {format_file_size(after)}")
+        elif args.command == 'verify':
+            problems = admin.verify(shard, quick=args.quick, prune=args.prune)
+            if not problems:
+                print("  OK")
+            for name, found in problems.items():
+                status = 1
+                print(f"  {name}: {len(found)}")
+                for item in found[:20]:
+                    print(f"    {item}")
+        elif args.command == 'stats':
+            stats = admin.stats(shard)
+            print(f"  Schema v{stats['schema_version']}, database {format_file_size(stats['db_size'])} ({format_file_size(stats['free_size'])} free)")
+            for media_type, count, size in stats['by_type']:
+                print(f"  {media_type}: {count} files, {format_file_size(size)}")
+            print(f"  Users: {stats['users']}, photo hashes: {stats['photo_hashes']}")
+        elif args.command == 'backup':
+            stats = archive_backup.backup(shard, args.destination)
+            print(f"  {stats['copied']} copied, {stats['removed']} removed, {stats['missing']} missing")
+    return status
+
+class FakeBotRequest(BaseRequest):
+    """In-process stand-in for the Bot API: answers every call, serves fake file downloads
+    
+    Each call waits latency seconds to mimic the round trip to Telegram.
+    File contents come from `files` (file_id -> (media_type, size)); photos
+    get a small generated image so perceptual hashing does real work.
+    """
+
+    BOT_USER = {'id': 1, 'is_bot': True, 'first_name': "Midea", 'username': "midea_loadtest_bot"}
+
+    def __init__(self, latency=0.0, files=None):
+        self.latency = latency
+        self.files = files or {}
+        self.calls = Counter()
+        self.message_ids = iter(range(1, 1 << 62))
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if '/file/' in url:
+            self.calls['download'] += 1
+            return 200, self.file_content(url.rsplit('/', 1)[-1])
+        
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] += 1
+        params = request_data.parameters if request_data else {}
+        return 200, json.dumps({'ok': True, 'result': self.result(endpoint, params)}).encode()
+
+    def result(self, endpoint, params):
+        """Plausible Bot API result for an endpoint"""
+        if endpoint == 'getMe':
+            return self.BOT_USER
+        if endpoint == 'getFile':
+            return {'file_id': params['file_id'], 'file_unique_id': params['file_id'], 'file_path': f"files/{params['file_id']}"}
+        if endpoint in ('sendChatAction', 'deleteMessage', 'setMyCommands', 'deleteWebhook'):
+            return True
+        
+        chat_id = int(params.get('chat_id') or 1)
+        message = {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup'},
+            'from': self.BOT_USER,
+            'text': str(params.get('text', ''))
+        }
+        if endpoint.startswith('send') and endpoint not in ('sendMessage', 'sendMediaGroup'):
+            # sendVideoNote -> video_note etc.; uploads get a fresh file_id
+            media_type = ''.join(f"_{c.lower()}" if c.isupper() else c for c in endpoint[4:]).lstrip('_')
+            media = {'file_id': f"sent{message['message_id']}", 'file_unique_id': f"sent{message['message_id']}",
+                     'width': 1, 'height': 1, 'duration': 1, 'length': 1}
+            message[media_type] = [media] if media_type == 'photo' else media
+        if endpoint == 'sendMediaGroup':
+            return [message]
+        return message
+
+    def file_content(self, file_id):
+        """Bytes served for a download: a generated image for photos, zeros otherwise"""
+        media_type, size = self.files.get(file_id, ('document', 1024))
+        if media_type == 'photo' and np is not None and Image is not None:
+            rng = np.random.default_rng(zlib.crc32(file_id.encode()))
+            image = Image.fromarray((rng.random((64, 64, 3)) * 255).astype('uint8'))
+            buffer = io.BytesIO()
+            image.save(buffer, 'JPEG')
+            return buffer.getvalue()
+        return bytes(min(size or 1024, LOADTEST_MAX_FILE_BYTES))
+
+class LoadTestHarness:
+    """Replay a recorded update stream through Application.process_update against a fake Bot API"""
+
+    def __init__(self, recording, speed=1.0, repeat=1, latency=0.0, media_root=None):
+        self.entries = [json.loads(line) for line in Path(recording).read_text().splitlines() if line.strip()]
+        self.speed = speed
+        self.repeat = repeat
+        self.latency = latency
+        self.media_root = media_root
+        self.latencies = []
+        self.loop_lags = []
+        self.errors = 0
+
+    def media_files(self):
+        """file_id -> (media_type, size) for every media mentioned in the recording"""
+        files = {}
+
+        def collect(value):
+            if isinstance(value, dict):
+                for media_type in MEDIA_SUBDIRS:
+                    media = value.get(media_type)
+                    for item in media if isinstance(media, list) else [media]:
+                        if isinstance(item, dict) and 'file_id' in item:
+                            for copy in range(self.repeat):
+                                files[self.copy_id(item['file_id'], copy)] = (media_type, item.get('file_size'))
+                for item in value.values():
+                    collect(item)
+            elif isinstance(value, list):
+                for item in value:
+                    collect(item)
+        
+        for entry in self.entries:
+            collect(entry['update'])
+        return files
+
+    @staticmethod
+    def copy_id(file_id, copy):
+        """Distinct file ids per repetition so repeats save new media"""
+        return file_id if copy == 0 else f"{file_id}r{copy}"
+
+    def prepare_update(self, data, copy, update_id):
+        """Fresh dates, ids and (for repeats) file ids for one replayed update"""
+        now = int(time.time())
+
+        def refresh(key, value):
+            if isinstance(value, dict):
+                return {name: refresh(name, item) for name, item in value.items()}
+            if isinstance(value, list):
+                return [refresh(key, item) for item in value]
+            if key == 'date':
+                return now
+            if key in ('file_id', 'file_unique_id'):
+                return self.copy_id(value, copy)
+            if key == 'message_id' and copy:
+                return value + copy * 10 ** 7
+            return value
+        
+        return {**refresh(None, data), 'update_id': update_id}
+
+    async def monitor_loop(self, stopped, interval=0.01):
+        """Measure how late short sleeps wake up, i.e. event loop lag"""
+        while not stopped.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.loop_lags.append(time.perf_counter() - started - interval)
+
+    async def replay_update(self, application, data, arrival):
+        """Process one update like the update fetcher does, timing it from its arrival"""
+        update = Update.de_json(data, application.bot)
+        await application.update_processor.process_update(update, application.process_update(update))
+        self.latencies.append(time.perf_counter() - arrival)
+
+    async def count_error(self, update, context):
+        """Error handler counting handler exceptions"""
+        self.errors += 1
+
+    async def run(self):
+        """Replay the recording and return the measurements"""
+        request = FakeBotRequest(self.latency, self.media_files())
+        bot = ReplySaveBot(request=request, media_root=self.media_root)
+        application = bot.application
+        application.add_error_handler(self.count_error)
+        await application.initialize()
+        await bot.post_init(application)
+        
+        stopped = asyncio.Event()
+        monitor = asyncio.create_task(self.monitor_loop(stopped))
+        rss_before = peak_rss()
+        tasks = []
+        started = time.perf_counter()
+        try:
+            duration = self.entries[-1]['offset'] if self.entries else 0
+            for copy in range(self.repeat):
+                for index, entry in enumerate(self.entries):
+                    # Schedule by recorded offset, compressed by the speed-up
+                    due = started + (copy * duration + entry['offset']) / self.speed
+                    delay = due - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    data = self.prepare_update(entry['update'], copy, copy * len(self.entries) + index + 1)
+                    tasks.append(asyncio.create_task(self.replay_update(application, data, time.perf_counter())))
+            await asyncio.gather(*tasks)
+            elapsed = time.perf_counter() - started
+        finally:
+            stopped.set()
+            await monitor
+            await application.shutdown()
+            await bot.post_shutdown(application)
+        
+        return {
+            'updates': len(tasks),
+            'elapsed': elapsed,
+            'latencies': sorted(self.latencies),
+            'loop_lags': sorted(self.loop_lags),
+            'errors': self.errors,
+            'rss_before': rss_before,
+            'rss_peak': peak_rss(),
+            'api_calls': request.calls
+        }
+
+def peak_rss():
+    """Process memory high-water mark in bytes, None where unsupported"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def synthesize_recording(path, albums=3, album_size=6, chatter=50, start_runs=3):
+    """Write a recording with album /save bursts, filename chatter and concurrent /start runs"""
+    group_id = LOG_GROUP_IDS[0]
+    counter = iter(range(1, 1 << 31))
+    entries = []
+
+    def message(chat_id, user_id, **fields):
+        return {
+            'message_id': next(counter), 'date': 0,
+            'chat': {'id': chat_id, 'type': 'supergroup' if chat_id < 0 else 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}", 'username': f"user{user_id}"},
+            **fields
+        }
+
+    def command(text):
+        return {'text': text, 'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]}
+
+    offset = 0.0
+    for album in range(albums):
+        # An album lands in the log group, then someone replies /save to it
+        media_group_id = f"album{album}"
+        posts = []
+        for item in range(album_size):
+            media_type = 'photo' if item % 2 == 0 else 'video'
+            file_id = f"synthetic{album}x{item}"
+            media = {'file_id': file_id, 'file_unique_id': file_id, 'width': 640, 'height': 480, 'file_size': 200_000}
+            if media_type == 'video':
+                media.update(duration=5, file_size=2_000_000)
+            post = message(group_id, 100 + album, media_group_id=media_group_id,
+                           **{media_type: [media] if media_type == 'photo' else media})
+            posts.append(post)
+            entries.append({'offset': round(offset, 3), 'update': {'message': post}})
+            offset += 0.05
+        entries.append({'offset': round(offset, 3), 'update': {'message': message(group_id, 200, reply_to_message=posts[0], **command("/save"))}})
+        offset += 1.0
+    
+    for index in range(chatter):
+        # Filename requests and near misses from private chats
+        text = f"{datetime.now().strftime('%Y%m%d')}_{index:06d}_synthetic.mp4" if index % 3 else f"synthetic{index}"
+        entries.append({'offset': round(offset, 3), 'update': {'message': message(1000 + index % 10, 1000 + index % 10, text=text)}})
+        offset += 0.1
+    
+    for index in range(start_runs):
+        entries.append({'offset': round(offset, 3), 'update': {'message': message(2000 + index, 2000 + index, **command("/start"))}})
+        offset += 0.01
+    
+    with open(path, 'w') as recording:
+        for entry in entries:
+            recording.write(json.dumps(entry) + "\n")
+    return len(entries)
+
+def loadtest_main(argv):
+    """Entry point of `python midea.py loadtest ...`"""
+    parser = argparse.ArgumentParser(prog="midea loadtest", description="Replay recorded traffic against a mocked Bot API")
+    commands = parser.add_subparsers(dest='command', required=True)
+    synth_parser = commands.add_parser('synthesize', help="Write a synthetic recording (album saves, chatter, /start runs)")
+    synth_parser.add_argument('recording', type=Path)
+    synth_parser.add_argument('--albums', type=int, default=3)
+    synth_parser.add_argument('--album-size', type=int, default=6)
+    synth_parser.add_argument('--chatter', type=int, default=50)
+    synth_parser.add_argument('--start-runs', type=int, default=3)
+    replay_parser = commands.add_parser('replay', help="Replay a recording and report throughput, latency, memory and loop lag")
+    replay_parser.add_argument('recording', type=Path)
+    replay_parser.add_argument('--speed', type=float, default=1.0, help="Speed-up factor over recorded timing")
+    replay_parser.add_argument('--repeat', type=int, default=1, help="Replay the recording this many times back to back")
+    replay_parser.add_argument('--api-latency', type=float, default=50.0, help="Simulated Bot API round trip in ms")
+    replay_parser.add_argument('--media-root', type=Path, help="Archive root to use (default: a temporary directory)")
+    args = parser.parse_args(argv)
+    
+    if args.command == 'synthesize':
+        count = synthesize_recording(args.recording, args.albums, args.album_size, args.chatter, args.start_runs)
+        print(f"Wrote {count} updates to {args.recording}")
+        return 0
+    
+    with tempfile.TemporaryDirectory(prefix="midea-loadtest-") as tmp_dir:
+        media_root = args.media_root or Path(tmp_dir)
+        # Keep the replay's audit trail out of the real one
+        listener = setup_logging(level=logging.WARNING, audit_file=Path(media_root) / "audit.jsonl")
+        try:
+            harness = LoadTestHarness(args.recording, args.speed, args.repeat, args.api_latency / 1000, media_root)
+            report = asyncio.run(harness.run())
+        finally:
+            listener.stop()
+    
+    latencies, lags = report['latencies'], report['loop_lags']
+    print(f"Updates:     {report['updates']} in {report['elapsed']:.2f}s ({report['updates'] / max(report['elapsed'], 1e-9):.1f}/s), {report['errors']} errors")
+    print("Latency ms:  " + "  ".join(f"p{int(q * 100)} {percentile(latencies, q) * 1000:.1f}" for q in (0.5, 0.95, 0.99)) + f"  max {percentile(latencies, 1) * 1000:.1f}")
+    print("Loop lag ms: " + "  ".join(f"p{int(q * 100)} {percentile(lags, q) * 1000:.1f}" for q in (0.5, 0.99)) + f"  max {percentile(lags, 1) * 1000:.1f}")
+    if report['rss_peak'] is not None:
+        print(f"Memory:      peak RSS {format_file_size(report['rss_peak'])} (at start {format_file_size(report['rss_before'])})")
+    print("API calls:   " + ", ".join(f"{endpoint} {count}" for endpoint, count in report['api_calls'].most_common()))
+    return 0
+
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["loadtest"]:
+        sys.exit(loadtest_main(sys.argv[2:]))
+    
+    atexit.register(setup_logging().stop)
+    
+    if sys.argv[1:2] == ["admin"]:
+        sys.exit(admin_main(sys.argv[2:]))
+    
     print("""
     🔧 Setup Instructions:
     
     1. Replace BOT_TOKEN with your actual bot token
-    2. Replace LOG_GROUP_ID with your log group ID
+    2. Replace LOG_GROUP_IDS with your log group IDs
     3. Add bot to your log group as admin
     4. Install dependencies: pip install python-telegram-bot
     5. Run: python reply_save_bot.py
@@ -1025,7 +4315,7 @@ if __name__ == "__main__":
     1. Add bot to your group
     2. Send a message in the group
     3. Check bot logs for chat_id (negative number)
-    4. Use that ID as LOG_GROUP_ID
+    4. Add that ID to LOG_GROUP_IDS
     
     💡 Usage:
     1. Send media to log group
@@ -1035,6 +4325,8 @@ if __name__ == "__main__":
     5. Use /get <filename> to retrieve media
     6. Use /delete <filename> to delete specific media
     7. Use /deleteall confirm to delete all media
+    8. Offline maintenance and backups: python reply_save_bot.py admin --help
+    9. Load testing: python reply_save_bot.py loadtest --help
     
     🆕 New Features:
     • Send any saved filename to get the media